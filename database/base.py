@@ -1,17 +1,75 @@
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from database.models import Base
+from config import DB_URL, SQLITE_BUSY_TIMEOUT, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE
+import inspect as pyinspect
 import os
 
-# Указываем путь к БД. Если мы в Докере, это будет важно.
-# Пока сохраним локально в файле bot.db
-DB_URL = "sqlite+aiosqlite:///bot.db"
-
 engine = create_async_engine(DB_URL, echo=False)
 
+if engine.dialect.name == "sqlite":
+    # Папку под файл базы создаем сами (например, data/ для Докера)
+    db_dir = os.path.dirname(engine.url.database or "")
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_connect(dbapi_connection, connection_record):
+        # Режим транзакций драйвера не трогаем: BEGIN он шлет перед первой записью, поэтому сессия
+        # "прочитал -> записал" ждет блокировку (busy_timeout), а не падает на устаревшем снимке.
+        # Свой BEGIN - только у миграций (database/migrations.py)
+        cursor = dbapi_connection.cursor()
+        # WAL: читатели не ждут писателя, коммит - дозапись в журнал без fsync основного файла.
+        # Режим хранится в самом файле, рядом появляются bot.db-wal и bot.db-shm
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # В WAL NORMAL не теряет целостность, fsync только на чекпоинтах
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Конкурентный коммит ждет блокировку, а не падает сразу с "database is locked"
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        # Отрицательное значение - размер в КБ, а не в страницах
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # Фабрика сессий - через нее мы будем делать запросы
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 async def init_db():
-    """Создает таблицы в БД, если их нет"""
+    """Создает недостающие таблицы и применяет миграции схемы"""
+    from database.migrations import run_migrations
     async with engine.begin() as conn:
+        # Новая база: create_all сразу создает актуальную схему, миграции только отмечаем
+        fresh = not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("tasks"))
         await conn.run_sync(Base.metadata.create_all)
+    await run_migrations(engine, fresh)
+
+def dialect_insert(model):
+    """INSERT текущего диалекта: у него есть on_conflict_do_nothing/do_update (SQLite и PostgreSQL)"""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+# ================= ЕДИНИЦА РАБОТЫ =================
+# Операции из services/cron_manager.py не коммитят сами: они делают flush и откладывают
+# побочные эффекты (планировщик, кэши) через on_commit. Коммитит владелец сессии - commit(session),
+# для хендлеров это UpdateContext (один коммит на апдейт)
+
+def on_commit(session: AsyncSession, callback):
+    """Выполнить callback (функция без аргументов, можно async) после успешного коммита сессии"""
+    session.info.setdefault("on_commit", []).append(callback)
+
+async def commit(session: AsyncSession):
+    """Коммит и отложенные эффекты. Эффекты не выполняются, если коммит упал"""
+    await session.commit()
+    for callback in session.info.pop("on_commit", []):
+        result = callback()
+        if pyinspect.isawaitable(result):
+            await result
+
+async def rollback(session: AsyncSession):
+    """Откат: отложенные эффекты выбрасываются"""
+    session.info.pop("on_commit", None)
+    await session.rollback()
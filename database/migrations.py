@@ -0,0 +1,178 @@
+"""
+Версионные миграции схемы.
+
+Каждая миграция - функция (version, name, fn), применяется один раз в своей транзакции:
+изменения схемы и запись в schema_migrations коммитятся вместе. Запускаются из init_db при старте.
+Миграции не падают на уже приведенной схеме: в старых базах часть разовых скриптов
+(migrate_*.py) могла быть применена вручную, а новую базу create_all создает сразу целиком.
+
+Вручную: python -m database.migrations
+"""
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy import inspect, select, insert, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from database.models import SchemaMigration
+from services.cron import normalize_cron, utcnow
+
+# Строк за один executemany в миграциях данных
+DATA_CHUNK = 1000
+
+
+@asynccontextmanager
+async def _transaction(engine: AsyncEngine):
+    """
+    Транзакция миграции. Драйвер sqlite3 не открывает транзакцию перед DDL - для SQLite
+    BEGIN/COMMIT шлем сами, чтобы схема и данные откатились целиком. Только здесь:
+    рабочие сессии живут в обычном режиме драйвера (см. database/base.py)
+    """
+    if engine.dialect.name != "sqlite":
+        async with engine.begin() as conn:
+            yield conn
+        return
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            await conn.exec_driver_sql("ROLLBACK")
+            raise
+        await conn.exec_driver_sql("COMMIT")
+
+
+async def _columns(conn: AsyncConnection, table: str) -> set[str]:
+    return await conn.run_sync(lambda sync_conn: {c["name"] for c in inspect(sync_conn).get_columns(table)})
+
+
+async def _add_column(conn: AsyncConnection, table: str, column: str, ddl: str):
+    if column in await _columns(conn, table): return
+    await conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    print(f"  ✅ {table}.{column} добавлена")
+
+
+async def _update_in_chunks(conn: AsyncConnection, select_sql: str, compute, update_sql: str):
+    """
+    Миграция данных: читает строки (id, ...) пачками по id, compute(row) -> параметры
+    для UPDATE или None (не трогать), пишет пачку одним executemany
+    """
+    last_id = 0
+    total = changed = 0
+    while True:
+        rows = (await conn.execute(text(select_sql), {"last_id": last_id, "limit": DATA_CHUNK})).all()
+        if not rows: break
+        params = [p for p in map(compute, rows) if p is not None]
+        if params:
+            await conn.execute(text(update_sql), params)
+        last_id = rows[-1][0]
+        total += len(rows)
+        changed += len(params)
+        print(f"  ⏳ Обработано: {total}, изменено: {changed}...")
+    return changed
+
+
+# --- МИГРАЦИИ ---
+
+async def _legacy_columns(conn: AsyncConnection):
+    """Колонки из старых разовых скриптов (migrate.py, migrate_media.py, migrate_share.py...)"""
+    await _add_column(conn, "tasks", "is_active", "BOOLEAN DEFAULT 1")
+    await _add_column(conn, "tasks", "content_type", "VARCHAR DEFAULT 'text'")
+    await _add_column(conn, "tasks", "file_id", "VARCHAR")
+    await _add_column(conn, "tasks", "share_link_token", "VARCHAR")
+    await _add_column(conn, "tasks", "next_run_at", "DATETIME")
+    await _add_column(conn, "tasks", "misfire_policy", "VARCHAR NOT NULL DEFAULT 'once'")
+
+
+async def _tasks_user_id_index(conn: AsyncConnection):
+    # Список задач чата: COUNT, страницы /list, задача по номеру
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_tasks_user_id_id ON tasks (user_id, id)")
+
+
+async def _tasks_is_active_index(conn: AsyncConnection):
+    # Восстановление и массовые паузы выбирают только активные задачи
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_tasks_is_active ON tasks (is_active)")
+
+
+async def _tasks_next_run_at_index(conn: AsyncConnection):
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_tasks_next_run_at ON tasks (next_run_at)")
+
+
+async def _share_tokens(conn: AsyncConnection):
+    """Токены для старых задач без share_link_token (бывший migrate_share.py)"""
+    await _update_in_chunks(
+        conn,
+        "SELECT id FROM tasks WHERE share_link_token IS NULL AND id > :last_id ORDER BY id LIMIT :limit",
+        lambda row: {"id": row[0], "token": str(uuid.uuid4())[:8]},
+        "UPDATE tasks SET share_link_token = :token WHERE id = :id",
+    )
+
+
+async def _cron_weekday_names(conn: AsyncConnection):
+    """Дни недели цифрами -> имена (бывший migrate_cron.py)"""
+    def compute(row):
+        task_id, cron = row
+        new_cron = normalize_cron(cron)
+        return {"id": task_id, "cron": new_cron} if new_cron != cron else None
+
+    await _update_in_chunks(
+        conn,
+        "SELECT id, cron_expression FROM tasks WHERE id > :last_id ORDER BY id LIMIT :limit",
+        compute,
+        "UPDATE tasks SET cron_expression = :cron WHERE id = :id",
+    )
+
+
+async def _tasks_scheduled_since(conn: AsyncConnection):
+    """Отметка для догоняющих запусков; для старых задач - последнее срабатывание из outbox (если есть)"""
+    await _add_column(conn, "tasks", "scheduled_since", "DATETIME")
+    await conn.exec_driver_sql(
+        "UPDATE tasks SET scheduled_since = "
+        "(SELECT MAX(scheduled_for) FROM outbox WHERE outbox.task_id = tasks.id) "
+        "WHERE scheduled_since IS NULL"
+    )
+
+
+# Новые миграции - только в конец, номера не менять
+MIGRATIONS = [
+    (1, "legacy_columns", _legacy_columns),
+    (2, "tasks_user_id_index", _tasks_user_id_index),
+    (3, "tasks_is_active_index", _tasks_is_active_index),
+    (4, "tasks_next_run_at_index", _tasks_next_run_at_index),
+    (5, "share_tokens", _share_tokens),
+    (6, "cron_weekday_names", _cron_weekday_names),
+    (7, "tasks_scheduled_since", _tasks_scheduled_since),
+]
+
+
+async def run_migrations(engine, fresh: bool = False):
+    """
+    Применяет недостающие миграции по порядку, каждую в своей транзакции.
+    fresh=True - базу только что создал create_all: миграции отмечаются без выполнения
+    """
+    async with engine.connect() as conn:
+        applied = set((await conn.execute(select(SchemaMigration.version))).scalars())
+
+    pending = [m for m in MIGRATIONS if m[0] not in applied]
+    if fresh and pending:
+        async with _transaction(engine) as conn:
+            now = utcnow()
+            await conn.execute(insert(SchemaMigration), [
+                {"version": version, "name": name, "applied_at": now} for version, name, _ in pending
+            ])
+        return
+
+    for version, name, migrate in pending:
+        print(f"🔄 Миграция {version}: {name}...")
+        async with _transaction(engine) as conn:
+            await migrate(conn)
+            await conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=utcnow()))
+        print(f"✅ Миграция {version} применена.")
+
+
+if __name__ == "__main__":
+    from database.base import init_db
+    asyncio.run(init_db())
@@ -1,4 +1,5 @@
-from sqlalchemy import BigInteger, String, ForeignKey, Boolean
+from datetime import datetime
+from sqlalchemy import BigInteger, String, Text, ForeignKey, Boolean, DateTime, UniqueConstraint, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 class Base(DeclarativeBase):
@@ -12,15 +13,25 @@ class User(Base):
 
 class Task(Base):
     __tablename__ = 'tasks'
+    # Список задач чата по порядку: COUNT и страницы /list идут по индексу, без сканирования таблицы
+    __table_args__ = (Index('ix_tasks_user_id_id', 'user_id', 'id'),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.user_id'))
     cron_expression: Mapped[str] = mapped_column(String)
     message_text: Mapped[str | None] = mapped_column(String, nullable=True)
-    is_active: Mapped[bool] = mapped_column(Boolean, default=True)
+    is_active: Mapped[bool] = mapped_column(Boolean, default=True, index=True)
     content_type: Mapped[str] = mapped_column(String, default="text")
     file_id: Mapped[str | None] = mapped_column(String, nullable=True)
     # share_link_token больше не нужен тут, но пусть висит, не мешает
     share_link_token: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Следующий запуск в UTC (без tzinfo). По нему работает DB-планировщик (SCHEDULER_MODE=db)
+    next_run_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, index=True)
+    # Что делать с запусками, пропущенными из-за рестарта/зависания: skip - ничего,
+    # once - отправить один раз, all - отправить каждый (в пределах MISFIRE_GRACE)
+    misfire_policy: Mapped[str] = mapped_column(String, default="once", server_default="once")
+    # С какого момента (UTC, без tzinfo) догонять пропущенные запуски при рестарте: последнее срабатывание,
+    # создание, запуск после паузы, смена расписания или пояса. Запуски до него не отправляются
+    scheduled_since: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     
     user: Mapped["User"] = relationship(back_populates="tasks")
 
@@ -31,4 +42,57 @@ class SharedLink(Base):
     cron_expression: Mapped[str] = mapped_column(String)
     message_text: Mapped[str | None] = mapped_column(String, nullable=True)
     content_type: Mapped[str] = mapped_column(String, default="text")
-    file_id: Mapped[str | None] = mapped_column(String, nullable=True)
\ No newline at end of file
+    file_id: Mapped[str | None] = mapped_column(String, nullable=True)
+
+class FailedDelivery(Base):
+    """Отправки, которые не удалось доставить после всех попыток (dead letter)"""
+    __tablename__ = 'failed_deliveries'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    task_id: Mapped[int | None] = mapped_column(nullable=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    # Копия содержимого на момент отправки: повтор сработает, даже если задачу уже удалили
+    message_text: Mapped[str | None] = mapped_column(String, nullable=True)
+    content_type: Mapped[str] = mapped_column(String, default="text")
+    file_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    error_class: Mapped[str] = mapped_column(String)
+    error_text: Mapped[str | None] = mapped_column(String, nullable=True)
+    attempts: Mapped[int] = mapped_column(default=1)
+    failed_at: Mapped[datetime] = mapped_column(DateTime)
+
+class OutboxEntry(Base):
+    """
+    Журнал срабатываний: одна строка на (задача, время запуска).
+    Уникальный ключ не дает отправить одно срабатывание дважды,
+    а строки без sent_at после падения процесса отправляются при старте.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (UniqueConstraint('task_id', 'scheduled_for', name='uq_outbox_task_scheduled'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    task_id: Mapped[int] = mapped_column()
+    # Время запуска по расписанию (UTC, без tzinfo)
+    scheduled_for: Mapped[datetime] = mapped_column(DateTime)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+    # Когда обработано: отправлено или окончательно не доставлено (тогда есть запись в failed_deliveries)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, index=True)
+
+class SchemaMigration(Base):
+    """Примененные миграции схемы (database/migrations.py)"""
+    __tablename__ = 'schema_migrations'
+
+    version: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    name: Mapped[str] = mapped_column(String)
+    applied_at: Mapped[datetime] = mapped_column(DateTime)
+
+class FsmRecord(Base):
+    """Состояние FSM (диалоги /add, /edit и режим группы), чтобы переживать рестарты"""
+    __tablename__ = 'fsm_states'
+
+    # Ключ aiogram: fsm:bot_id:chat_id:user_id:destiny
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    state: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Данные FSM в JSON
+    data: Mapped[str] = mapped_column(Text, default="{}")
+    # Последнее использование: по нему удаляются брошенные состояния
+    updated_at: Mapped[datetime] = mapped_column(DateTime, index=True)
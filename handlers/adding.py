@@ -1,13 +1,11 @@
 from aiogram import Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select
 
-from database.base import async_session
-from database.models import User
 from services.cron_manager import add_task, validate_cron
+from middlewares import UpdateContext
 from keyboards import get_presets_keyboard, get_weekdays_keyboard, get_months_keyboard
-from handlers.common import TaskStates, clear_state_keep_group, get_target_id, validate_time_format, humanize_cron 
+from handlers.common import TaskStates, clear_state_keep_group, validate_time_format, humanize_cron, addgroup_link
 
 router = Router()
 
@@ -15,23 +13,20 @@ router = Router()
 # ================= ЛОГИКА ДОБАВЛЕНИЯ (/add) =================
 
 @router.message(Command("add"))
-async def cmd_add(message: types.Message, state: FSMContext):
+async def cmd_add(message: types.Message, state: FSMContext, bot_user: types.User):
     group_id = await clear_state_keep_group(state)
     if message.chat.type == "private":
         target_text = " для <b>ГРУППЫ</b>" if group_id else ""
         await message.answer(f"📅 Как будем настраивать расписание{target_text}?", reply_markup=get_presets_keyboard(), parse_mode="HTML")
         await state.set_state(TaskStates.waiting_for_preset)
         return
-    chat_id = message.chat.id
-    bot_username = (await message.bot.get_me()).username
-    safe_chat_id = str(chat_id).replace("-", "m")
-    url = f"https://t.me/{bot_username}?start=addgroup_{safe_chat_id}"
+    url = addgroup_link(bot_user, message.chat.id)
     kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⚙️ Настроить в ЛС", url=url)]])
     await message.answer("Настрой задачу у меня в личке:", reply_markup=kb)
 
 @router.message(F.text == "➕ Добавить в группу")
-async def menu_add_group(message: types.Message, state: FSMContext):
-    await cmd_add(message, state)
+async def menu_add_group(message: types.Message, state: FSMContext, bot_user: types.User):
+    await cmd_add(message, state, bot_user)
 
 @router.callback_query(TaskStates.waiting_for_preset)
 async def process_preset_choice(callback: types.CallbackQuery, state: FSMContext):
@@ -173,7 +168,7 @@ async def process_custom_cron(message: types.Message, state: FSMContext):
 # ================= ОБРАБОТКА МЕДИА =================
 
 @router.message(TaskStates.adding_text, ~F.text.startswith("/"))
-async def process_add_content(message: types.Message, state: FSMContext):
+async def process_add_content(message: types.Message, state: FSMContext, ctx: UpdateContext):
     content_type = "text"
     file_id = None
     text_content = message.text or message.caption or ""
@@ -213,38 +208,34 @@ async def process_add_content(message: types.Message, state: FSMContext):
         await state.set_state(TaskStates.waiting_for_media_note)
         return
 
-    await finalize_task(message, state)
+    await finalize_task(message, state, ctx)
 
 @router.message(TaskStates.waiting_for_media_note, ~F.text.startswith("/"))
-async def process_media_note(message: types.Message, state: FSMContext):
+async def process_media_note(message: types.Message, state: FSMContext, ctx: UpdateContext):
     text = message.text
     if text == "➡️ Оставить без текста" or text == "/skip":
         text = ""
     await state.update_data(final_text=text)
-    await finalize_task(message, state)
+    await finalize_task(message, state, ctx)
 
-async def finalize_task(message: types.Message, state: FSMContext):
+async def finalize_task(message: types.Message, state: FSMContext, ctx: UpdateContext):
     data = await state.get_data()
     cron_exp = data['cron_exp']
     msg_text = data.get('final_text', "")
     c_type = data.get('content_type', "text")
     f_id = data.get('file_id')
     
-    target_id = await get_target_id(message, state)
+    target_id = await ctx.target_id()
     
-    async with async_session() as session:
-        res = await session.execute(select(User).where(User.user_id == target_id))
-        if not res.scalar_one_or_none():
-            session.add(User(user_id=target_id, timezone="Asia/Yekaterinburg"))
-            await session.commit()
-
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res.scalar() or "Asia/Yekaterinburg"
+    # Заодно создает запись чата в users, если ее еще нет
+    user_tz = await ctx.timezone()
 
+    async with ctx.db() as session:
         try:
             await add_task(bot=message.bot, session=session, user_id=target_id, 
                            cron_exp=cron_exp, text=msg_text, timezone_str=user_tz,
                            content_type=c_type, file_id=f_id)
+            await ctx.commit()
             
             t_name = "в <b>ГРУППУ</b>" if target_id != message.from_user.id else ""
             
@@ -252,6 +243,7 @@ async def finalize_task(message: types.Message, state: FSMContext):
             current_kb = types.ReplyKeyboardRemove()
             await message.answer(f"✅ Задача сохранена {t_name}!", parse_mode="HTML", reply_markup=current_kb)
         except Exception as e:
+            await ctx.rollback()
             await message.answer(f"❌ Ошибка: {e}")
 
     group_id = await clear_state_keep_group(state)
@@ -0,0 +1,41 @@
+from aiogram import Router, F, types
+from aiogram.filters import Command
+
+from config import ADMIN_IDS
+from services.dead_letters import failed_summary, replay_failed
+from services.delivery import delivery
+
+router = Router()
+# Служебные команды только для ADMIN_IDS и только в личке
+router.message.filter(F.chat.type == "private", F.from_user.id.in_(ADMIN_IDS))
+router.callback_query.filter(F.from_user.id.in_(ADMIN_IDS))
+
+
+def _failed_text(summary) -> str:
+    total = sum(count for _, count in summary)
+    stats = delivery.stats()
+    lines = [
+        f"📮 <b>Неудачные отправки:</b> {total}",
+        f"Очередь: {stats['queued']} (+{stats['deferred']} ждут), скорость: {stats['rate']}/сек\n",
+    ]
+    for error, count in summary:
+        lines.append(f"• <code>{error}</code>: {count}")
+    return "\n".join(lines)
+
+
+@router.message(Command("failed"))
+async def cmd_failed(message: types.Message):
+    summary = await failed_summary()
+    kb = None
+    if summary:
+        kb = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="🔁 Отправить все повторно", callback_data="failed_replay")]
+        ])
+    await message.answer(_failed_text(summary), reply_markup=kb, parse_mode="HTML")
+
+
+@router.callback_query(F.data == "failed_replay")
+async def callback_failed_replay(callback: types.CallbackQuery):
+    count = await replay_failed()
+    await callback.message.edit_text(f"🔁 Возвращено в очередь: <b>{count}</b>", parse_mode="HTML")
+    await callback.answer()
@@ -1,60 +1,60 @@
-import re # Нам понадобятся регулярки
+import html
+import io
+import os
+import tempfile
+import zlib
 from aiogram import Router, F, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select
+from aiogram.types import FSInputFile
+from sqlalchemy.exc import SQLAlchemyError
 
-from database.base import async_session
-from database.models import User, Task
-from services.cron_manager import add_task, validate_cron
+from middlewares import UpdateContext
+from services.backup import (
+    import_tasks, export_tasks, open_upload, EXPORT_FORMATS, DEFAULT_EXPORT_FORMAT,
+)
 from handlers.common import TaskStates, clear_state_keep_group, get_target_id, get_target_name
 
 router = Router()
 
+# Сколько ошибок показывать в отчете (сообщение ограничено 4096 символами)
+MAX_REPORT_ERRORS = 30
+# До какого размера (байт) txt-бэкап отправляется текстом, а не файлом
+INLINE_EXPORT_LIMIT = 4000
+# Какие файлы принимает /import
+IMPORT_EXTENSIONS = (".txt", ".ndjson", ".jsonl", ".gz")
+
 # ================= ЭКСПОРТ =================
 
 @router.message(Command("export"))
-async def cmd_export(message: types.Message, state: FSMContext):
+async def cmd_export(message: types.Message, command: CommandObject, state: FSMContext):
     target_id = await get_target_id(message, state)
     await clear_state_keep_group(state)
     t_name = "ГРУППЫ" if target_id != message.from_user.id else "твои"
-    
-    async with async_session() as session:
-        query = select(Task).where(Task.user_id == target_id).order_by(Task.id)
-        result = await session.execute(query)
-        tasks = result.scalars().all()
 
-    if not tasks:
-        await message.answer(f"Задач ({t_name}) для экспорта нет.")
+    fmt = (command.args or DEFAULT_EXPORT_FORMAT).strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        await message.answer(f"❌ Формат: {', '.join(EXPORT_FORMATS)}. Например: <code>/export ndjson</code>", parse_mode="HTML")
         return
 
-    export_lines = []
-    for task in tasks:
-        # Формируем текст
-        # Если есть медиа -> [photo:Age...] Текст
-        # Если нет -> Текст
-        
-        content_prefix = ""
-        if task.content_type != "text" and task.file_id:
-            content_prefix = f"[{task.content_type}:{task.file_id}] "
-        
-        # text может быть None, заменим на ""
-        safe_text = task.message_text or ""
-        
-        block = f"{task.cron_expression}\n{content_prefix}{safe_text}"
-        export_lines.append(block)
-    
-    full_text = "\n==========\n".join(export_lines)
-    
-    if len(full_text) > 4000:
-        from aiogram.types import BufferedInputFile
-        file = BufferedInputFile(full_text.encode("utf-8"), filename="tasks_backup.txt")
-        await message.answer_document(file, caption=f"📂 Бэкап задач ({t_name})")
-    else:
-        await message.answer(
-            f"<code>{full_text}</code>", 
-            parse_mode="HTML"
-        )
+    # Бэкап пишется потоком во временный файл и уходит с диска, а не из памяти
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f"tasks_backup.{EXPORT_FORMATS[fmt]}")
+        with open(path, "wb") as out:
+            count = await export_tasks(target_id, fmt, out)
+
+        if not count:
+            await message.answer(f"Задач ({t_name}) для экспорта нет.")
+            return
+
+        # Небольшой текстовый бэкап - прямо в сообщении, как раньше
+        if fmt == "txt" and os.path.getsize(path) <= INLINE_EXPORT_LIMIT:
+            with open(path, encoding="utf-8") as f:
+                full_text = f.read()
+            await message.answer(f"<code>{html.escape(full_text)}</code>", parse_mode="HTML")
+            return
+
+        await message.answer_document(FSInputFile(path), caption=f"📂 Бэкап задач ({t_name}): {count}")
 
 # ================= ИМПОРТ =================
 
@@ -66,75 +66,53 @@ async def cmd_import(message: types.Message, state: FSMContext):
     
     await message.answer(
         f"📥 <b>Импорт задач{t_name}</b>\n\n"
-        "Пришли список задач. Поддерживаю медиа-теги:\n"
-        "<code>[sticker:ID]</code>, <code>[photo:ID]</code> и т.д.",
+        "Пришли список задач текстом или файлом бэкапа (.txt, .ndjson, .ndjson.gz) любого размера.\n"
+        "В тексте поддерживаю медиа-теги: <code>[sticker:ID]</code>, <code>[photo:ID]</code> и т.д.",
         parse_mode="HTML"
     )
     await state.set_state(TaskStates.waiting_for_import)
 
-@router.message(TaskStates.waiting_for_import, ~F.text.startswith("/"))
-async def process_import(message: types.Message, state: FSMContext):
-    text = message.text
-    target_id = await get_target_id(message, state)
-    
-    blocks = text.split("==========")
-    success_count = 0
-    errors = []
-    
-    async with async_session() as session:
-        res = await session.execute(select(User).where(User.user_id == target_id))
-        if not res.scalar_one_or_none():
-             session.add(User(user_id=target_id, timezone="Asia/Yekaterinburg"))
-             await session.commit()
-
-        res2 = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res2.scalar() or "Asia/Yekaterinburg"
-
-        for i, block in enumerate(blocks, 1):
-            block = block.strip()
-            if not block: continue
-            
-            lines = block.split("\n", 1)
-            if len(lines) < 2:
-                errors.append(f"Блок {i}: Нет текста")
-                continue
-                
-            cron_exp = lines[0].strip()
-            raw_text = lines[1].strip()
-            
-            # --- ПАРСИНГ МЕДИА ---
-            # Ищем паттерн [type:ID] в начале текста
-            # Например: [photo:AgAC...] Доброе утро
-            
-            c_type = "text"
-            f_id = None
-            final_text = raw_text
-            
-            match = re.match(r"^\[(\w+):(.+?)\]\s?(.*)", raw_text, re.DOTALL)
-            if match:
-                c_type = match.group(1) # photo
-                f_id = match.group(2)   # ID
-                final_text = match.group(3) # Остаток текста
-            
-            # Валидация
-            is_valid, _ = validate_cron(cron_exp)
-            if not is_valid:
-                errors.append(f"Блок {i}: Неверный Cron")
-                continue
-            
-            try:
-                await add_task(
-                    bot=message.bot, session=session, user_id=target_id,
-                    cron_exp=cron_exp, text=final_text, timezone_str=user_tz,
-                    content_type=c_type, file_id=f_id
-                )
-                success_count += 1
-            except Exception as e:
-                errors.append(f"Блок {i}: Ошибка БД {e}")
+@router.message(TaskStates.waiting_for_import, F.document)
+async def process_import_file(message: types.Message, state: FSMContext, ctx: UpdateContext):
+    doc = message.document
+    if not (doc.file_name or "").lower().endswith(IMPORT_EXTENSIONS):
+        await message.answer("❌ Нужен файл .txt, .ndjson или .ndjson.gz (например, из /export).")
+        return
+
+    # Файл на диск, а не в память: читаем построчно
+    with tempfile.TemporaryFile() as raw:
+        await message.bot.download(doc, destination=raw)
+        raw.seek(0)
+        lines = io.TextIOWrapper(open_upload(raw), encoding="utf-8-sig", errors="replace")
+        await run_import(message, state, ctx, lines)
+
+@router.message(TaskStates.waiting_for_import, F.text, ~F.text.startswith("/"))
+async def process_import(message: types.Message, state: FSMContext, ctx: UpdateContext):
+    await run_import(message, state, ctx, message.text.splitlines(keepends=True))
+
+async def run_import(message: types.Message, state: FSMContext, ctx: UpdateContext, lines):
+    target_id = await ctx.target_id()
+    # Заодно создает запись чата в users, если ее еще нет
+    user_tz = await ctx.timezone()
+
+    try:
+        success_count, errors = await import_tasks(target_id, user_tz, lines)
+    except (OSError, EOFError, zlib.error) as e:
+        # Битый или обрезанный .gz: файл разбирается целиком до записи, в БД ничего не попало
+        await message.answer(f"❌ Импорт не выполнен, файл поврежден: {html.escape(str(e))}")
+        await clear_state_keep_group(state)
+        return
+    except SQLAlchemyError as e:
+        # Одна транзакция: при ошибке БД не импортировано ничего
+        await message.answer(f"❌ Импорт не выполнен, ошибка БД: {html.escape(str(e))}")
+        await clear_state_keep_group(state)
+        return
 
     report = f"✅ Импортировано: <b>{success_count}</b> задач.\n"
     if errors:
-        report += "\n⚠️ <b>Ошибки:</b>\n" + "\n".join(errors)
+        report += f"\n⚠️ <b>Ошибки ({len(errors)}):</b>\n" + "\n".join(html.escape(e) for e in errors[:MAX_REPORT_ERRORS])
+        if len(errors) > MAX_REPORT_ERRORS:
+            report += f"\n... и еще {len(errors) - MAX_REPORT_ERRORS}"
     
     await message.answer(report, parse_mode="HTML")
-    await clear_state_keep_group(state)
\ No newline at end of file
+    await clear_state_keep_group(state)
@@ -3,12 +3,14 @@ from urllib.parse import quote
 from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from sqlalchemy import select, update
+from sqlalchemy import select
 
-from services.cron_manager import add_task 
-from database.base import async_session
+from services.cron_manager import add_task, reschedule_chat
+from database.base import dialect_insert, on_commit
 from database.models import User, Task, SharedLink
+from services.chat_settings import chat_settings
 from keyboards import get_group_mode_keyboard
+from middlewares import UpdateContext
 
 print("LOADED: common")
 
@@ -56,20 +58,21 @@ class TaskStates(StatesGroup):
     waiting_for_import = State()
 
 # ================= ХЕЛПЕРЫ (HELPERS) =================
+# state в хендлерах - CachedFSMContext из UpdateContextMiddleware: данные FSM читаются
+# из хранилища один раз за апдейт, повторные вызовы хелперов идут из памяти.
+# Там, где нужен еще и часовой пояс цели, удобнее ctx: UpdateContext
 
 async def clear_state_keep_group(state: FSMContext):
     """Очищает состояние, но сохраняет активную группу (Sticky Session)"""
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
-    await state.clear()
-    if group_id:
-        await state.update_data(active_group_id=group_id)
+    group_id = await state.get_value("active_group_id")
+    # Без clear() + update_data(): одна запись данных вместо трех (состояния хранятся в БД)
+    await state.set_state(None)
+    await state.set_data({"active_group_id": group_id} if group_id else {})
     return group_id
 
 async def get_target_id(event: types.Message | types.CallbackQuery, state: FSMContext):
     """Возвращает ID группы (если мы в режиме) или ID юзера"""
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
+    group_id = await state.get_value("active_group_id")
     if group_id:
         return group_id
     
@@ -78,19 +81,37 @@ async def get_target_id(event: types.Message | types.CallbackQuery, state: FSMCo
 
 async def get_target_name(state: FSMContext):
     """Возвращает текст для сообщений: ' (для ГРУППЫ)' или ''"""
-    data = await state.get_data()
-    return " (для <b>ГРУППЫ</b>)" if data.get("active_group_id") else ""
+    return " (для <b>ГРУППЫ</b>)" if await state.get_value("active_group_id") else ""
 
 async def get_real_task_by_number(session, target_id: int, task_number: int):
-    """Переводит порядковый номер (1, 2...) в реальный ID задачи"""
+    """Переводит порядковый номер (1, 2...) в задачу. Одна строка по индексу (user_id, id)"""
     if task_number < 1: return None
-    query = select(Task).where(Task.user_id == target_id).order_by(Task.id)
+    query = select(Task).where(Task.user_id == target_id).order_by(Task.id).limit(1).offset(task_number - 1)
     result = await session.execute(query)
-    tasks = result.scalars().all()
-    if task_number <= len(tasks): return tasks[task_number - 1]
-    return None
-
-async def apply_timezone(message: types.Message, offset_str: str, target_id: int):
+    return result.scalar_one_or_none()
+
+async def get_task_by_id(session, target_id: int, task_id: int):
+    """Задача по реальному ID, только если она принадлежит target_id"""
+    result = await session.execute(select(Task).where(Task.id == task_id, Task.user_id == target_id))
+    return result.scalar_one_or_none()
+
+def parse_task_ref(data: str):
+    """
+    Разбирает callback '<действие>_<номер>_<id>' -> (номер, id).
+    В кнопках старых сообщений id нет: '<действие>_<номер>' -> (номер, None)
+    """
+    parts = data.split("_")
+    if len(parts) >= 2 and parts[-1].isdigit() and parts[-2].isdigit():
+        return int(parts[-2]), int(parts[-1])
+    return int(parts[-1]), None
+
+async def resolve_task(session, target_id: int, task_number: int, task_id: int | None = None):
+    """Задача по ID из кнопки (не съезжает, если удалили задачи выше), иначе по номеру"""
+    if task_id is not None:
+        return await get_task_by_id(session, target_id, task_id)
+    return await get_real_task_by_number(session, target_id, task_number)
+
+async def apply_timezone(message: types.Message, ctx: UpdateContext, offset_str: str, target_id: int):
     """Применяет часовой пояс к target_id (юзеру или группе)"""
     try:
         offset = int(offset_str)
@@ -102,15 +123,18 @@ async def apply_timezone(message: types.Message, offset_str: str, target_id: int
     posix_sign = -1 * offset
     tz_name = f"Etc/GMT{posix_sign:+d}"
 
-    async with async_session() as session:
-        # Проверяем, есть ли запись в таблице users
-        res = await session.execute(select(User).where(User.user_id == target_id))
-        if not res.scalar_one_or_none():
-            session.add(User(user_id=target_id))
-        
-        stmt = update(User).where(User.user_id == target_id).values(timezone=tz_name)
+    async with ctx.db() as session:
+        # Один upsert: создает запись в users, если ее нет
+        stmt = (
+            dialect_insert(User).values(user_id=target_id, timezone=tz_name)
+            .on_conflict_do_update(index_elements=[User.user_id], set_={"timezone": tz_name})
+        )
         await session.execute(stmt)
-        await session.commit()
+        on_commit(session, lambda: chat_settings.invalidate(target_id))
+        # Уже запущенные задачи переводим на новый пояс сразу, а не после рестарта
+        on_commit(session, lambda: reschedule_chat(target_id, tz_name))
+    await ctx.commit()
+    ctx.invalidate_timezone()
     
     target_text = " для <b>ГРУППЫ</b>" if target_id != message.from_user.id else ""
     await message.answer(f"✅ Часовой пояс{target_text} установлен: <b>UTC{offset:+d}</b>", parse_mode="HTML")
@@ -118,21 +142,17 @@ async def apply_timezone(message: types.Message, offset_str: str, target_id: int
 # ================= БАЗОВЫЕ КОМАНДЫ =================
 
 @router.message(Command("start"))
-async def cmd_start(message: types.Message, command: CommandObject, state: FSMContext):
+async def cmd_start(message: types.Message, command: CommandObject, state: FSMContext, ctx: UpdateContext):
     await state.clear() # Полный сброс при старте
     user_id = message.from_user.id
     
-    # Регистрация юзера
-    async with async_session() as session:
-        res = await session.execute(select(User).where(User.user_id == user_id))
-        if not res.scalar_one_or_none():
-            session.add(User(user_id=user_id))
-            await session.commit()
+    # Регистрация юзера (кэш настроек создает запись, если ее нет)
+    await chat_settings.get_timezone(user_id)
 
     # Проверка Deep Link (Режим Группы)
     args = command.args
-    if args and args.startswith("addgroup_"):
-        safe_group_id = args.replace("addgroup_", "")
+    if args and args.startswith(ADDGROUP_PREFIX):
+        safe_group_id = args.replace(ADDGROUP_PREFIX, "")
         try:
             real_group_id = int(safe_group_id.replace("m", "-"))
         except ValueError:
@@ -150,10 +170,10 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
             parse_mode="HTML"
         )
         return
-    elif args and args.startswith("share_"):
-        token = args.replace("share_", "")
+    elif args and args.startswith(SHARE_PREFIX):
+        token = args.replace(SHARE_PREFIX, "")
                 
-        async with async_session() as session:
+        async with ctx.db() as session:
             res = await session.execute(select(SharedLink).where(SharedLink.token == token))
             shared_task = res.scalar_one_or_none()
             
@@ -215,28 +235,26 @@ async def cmd_help(message: types.Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML")
 
 @router.message(Command("timezone"))
-async def cmd_timezone(message: types.Message, state: FSMContext):
+async def cmd_timezone(message: types.Message, state: FSMContext, ctx: UpdateContext):
     target_id = await get_target_id(message, state)
     await clear_state_keep_group(state)
     
     args = message.text.split(maxsplit=1)
     if len(args) > 1:
-        await apply_timezone(message, args[1], target_id)
+        await apply_timezone(message, ctx, args[1], target_id)
         return
     
     # Получаем текущую зону
-    async with async_session() as session:
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        current_tz = res.scalar() or "UTC"
-        # Красивый вывод (Etc/GMT-3 -> UTC+3)
-        try:
-            if "Etc/GMT" in current_tz:
-                offset = int(current_tz.replace("Etc/GMT", ""))
-                display_tz = f"UTC{-offset:+d}" # Инверсия знака
-            else:
-                display_tz = current_tz
-        except:
+    current_tz = await chat_settings.get_timezone(target_id)
+    # Красивый вывод (Etc/GMT-3 -> UTC+3)
+    try:
+        if "Etc/GMT" in current_tz:
+            offset = int(current_tz.replace("Etc/GMT", ""))
+            display_tz = f"UTC{-offset:+d}" # Инверсия знака
+        else:
             display_tz = current_tz
+    except:
+        display_tz = current_tz
     
     t_name = await get_target_name(state)
     await message.answer(
@@ -247,9 +265,9 @@ async def cmd_timezone(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_timezone)
 
 @router.message(TaskStates.waiting_for_timezone, ~F.text.startswith("/"))
-async def process_tz(message: types.Message, state: FSMContext):
+async def process_tz(message: types.Message, state: FSMContext, ctx: UpdateContext):
     target_id = await get_target_id(message, state)
-    await apply_timezone(message, message.text, target_id)
+    await apply_timezone(message, ctx, message.text, target_id)
     await clear_state_keep_group(state)
 
 # --- МЕНЮ РЕЖИМА ГРУППЫ ---
@@ -286,26 +304,23 @@ async def help_callback(callback: types.CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("accept_share_"))
-async def process_share_accept(callback: types.CallbackQuery, state: FSMContext):
+async def process_share_accept(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
     token = callback.data.replace("accept_share_", "")
     
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
-    target_id = group_id if group_id else callback.from_user.id 
+    target_id = await ctx.target_id()
+    # До первого запроса в сессии: на промахе кэш сам пишет в users
+    user_tz = await ctx.timezone()
     
     from database.models import SharedLink 
     from services.cron_manager import add_task
     
-    async with async_session() as session:
+    async with ctx.db() as session:
         res = await session.execute(select(SharedLink).where(SharedLink.token == token))
         shared_task = res.scalar_one_or_none()
         
         if not shared_task:
             await callback.answer("Ссылка недействительна.", show_alert=True)
             return
-
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res.scalar() or "Asia/Yekaterinburg"
         
         try:
             await add_task(
@@ -318,9 +333,11 @@ async def process_share_accept(callback: types.CallbackQuery, state: FSMContext)
                 content_type=shared_task.content_type,
                 file_id=shared_task.file_id
             )
+            await ctx.commit()
             
             await callback.message.edit_text(f"✅ Задача успешно добавлена!")
         except Exception as e:
+            await ctx.rollback()
             await callback.message.edit_text(f"❌ Ошибка: {e}")
             
     await callback.answer()
@@ -404,4 +421,22 @@ def get_share_text(task: Task) -> str:
     readable_cron = humanize_cron(task.cron_expression)
     share_text_parts = [f"{readable_cron}", task.message_text]
     share_text = "\r\n".join(filter(None, share_text_parts))
-    return quote(share_text)
\ No newline at end of file
+    return quote(share_text)
+
+# ================= DEEP LINKS =================
+# bot_user - результат bot.get_me(): запрашивается один раз в main() и приходит в хендлеры
+# через данные диспетчера (параметр bot_user), без похода в Bot API на каждый клик
+
+ADDGROUP_PREFIX = "addgroup_"
+SHARE_PREFIX = "share_"
+
+def deep_link(bot_user: types.User, payload: str) -> str:
+    """Ссылка t.me на бота с параметром /start"""
+    return f"https://t.me/{bot_user.username}?start={payload}"
+
+def addgroup_link(bot_user: types.User, chat_id: int) -> str:
+    # В параметре /start нельзя "-": id группы кодируем как m123...
+    return deep_link(bot_user, ADDGROUP_PREFIX + str(chat_id).replace("-", "m"))
+
+def share_link(bot_user: types.User, token: str) -> str:
+    return deep_link(bot_user, SHARE_PREFIX + token)
\ No newline at end of file
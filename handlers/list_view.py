@@ -1,35 +1,43 @@
 from aiogram import Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select
-from datetime import datetime
-from croniter import croniter
-import pytz
+from sqlalchemy import select, func
 import math
 
-from database.base import async_session
-from database.models import User, Task
-from handlers.common import TaskStates, clear_state_keep_group, get_target_id, humanize_cron, get_real_task_by_number, get_share_text
+from database.models import Task
+from handlers.common import (
+    TaskStates, clear_state_keep_group, get_target_id, humanize_cron, get_share_text, parse_task_ref, resolve_task,
+    share_link
+)
 
 # Импортируем функции действий (чтобы вызывать их из кнопок)
-from services.cron_manager import pause_task, resume_task, delete_task, create_share_snapshot
+from services.cron_manager import pause_task, resume_task, delete_task, create_share_snapshot, set_misfire_policy
+from services.cron import next_fire
+from services.chat_settings import chat_settings
 from handlers.task_actions import start_editing_menu # Для кнопки Edit
+from middlewares import UpdateContext
 
 router = Router()
 
 ITEMS_PER_PAGE = 10
 
+# Что делать с запусками, пропущенными пока бот был недоступен
+MISFIRE_LABELS = {
+    "skip": "не отправлять",
+    "once": "отправить один раз",
+    "all": "отправить все",
+}
+
 # --- ХЕЛПЕР: Клавиатура Списка ---
-def get_list_keyboard(total_tasks, page=1):
+def get_list_keyboard(total_tasks, page=1, task_ids=()):
     kb = []
     
-    # 1. Кнопки с номерами
+    # 1. Кнопки с номерами (в колбэке и номер для заголовка, и реальный ID задачи)
     start_idx = (page - 1) * ITEMS_PER_PAGE
-    end_idx = min(start_idx + ITEMS_PER_PAGE, total_tasks)
     
     row = []
-    for i in range(start_idx + 1, end_idx + 1):
-        row.append(types.InlineKeyboardButton(text=str(i), callback_data=f"list_select_{i}"))
+    for i, task_id in enumerate(task_ids, start_idx + 1):
+        row.append(types.InlineKeyboardButton(text=str(i), callback_data=f"list_select_{i}_{task_id}"))
         if len(row) == 5: # 5 кнопок в ряд
             kb.append(row)
             row = []
@@ -52,19 +60,24 @@ def get_list_keyboard(total_tasks, page=1):
     return types.InlineKeyboardMarkup(inline_keyboard=kb)
 
 # --- ХЕЛПЕР: Клавиатура Карточки ---
-def get_task_keyboard(task_num, is_active):
+def get_task_keyboard(task_num, task_id, is_active, misfire_policy="once"):
+    ref = f"{task_num}_{task_id}"
     pause_btn_text = "⏸ Пауза" if is_active else "▶️ Старт"
-    pause_callback = f"task_pause_{task_num}" if is_active else f"task_resume_{task_num}"
+    pause_callback = f"task_pause_{ref}" if is_active else f"task_resume_{ref}"
     
     kb = [
         [
-            types.InlineKeyboardButton(text="✏️ Изменить", callback_data=f"task_edit_{task_num}"),
+            types.InlineKeyboardButton(text="✏️ Изменить", callback_data=f"task_edit_{ref}"),
             types.InlineKeyboardButton(text=pause_btn_text, callback_data=pause_callback)
         ],
         [
-            types.InlineKeyboardButton(text="🔗 Поделиться", callback_data=f"task_share_{task_num}"),
-            types.InlineKeyboardButton(text="🗑 Удалить", callback_data=f"task_delete_confirm_{task_num}")
+            types.InlineKeyboardButton(text="🔗 Поделиться", callback_data=f"task_share_{ref}"),
+            types.InlineKeyboardButton(text="🗑 Удалить", callback_data=f"task_delete_confirm_{ref}")
         ],
+        [types.InlineKeyboardButton(
+            text=f"🕒 Пропуски: {MISFIRE_LABELS.get(misfire_policy, misfire_policy)}",
+            callback_data=f"task_misfire_{ref}"
+        )],
         [types.InlineKeyboardButton(text="🔙 Назад к списку", callback_data="list_back")]
     ]
     return types.InlineKeyboardMarkup(inline_keyboard=kb)
@@ -73,38 +86,44 @@ def get_task_keyboard(task_num, is_active):
 # ================= КОМАНДА /LIST =================
 
 @router.message(Command("list"))
-async def cmd_list(message: types.Message, state: FSMContext):
+async def cmd_list(message: types.Message, state: FSMContext, ctx: UpdateContext):
     target_id = await get_target_id(message, state)
     await clear_state_keep_group(state)
     
     # Показываем 1-ю страницу
-    await show_list_page(message, target_id, page=1)
+    await show_list_page(message, ctx, target_id, page=1)
 
 # Функция отрисовки страницы (вынесена, чтобы вызывать из колбэка пагинации)
-async def show_list_page(message_or_callback, target_id, page):
+async def show_list_page(message_or_callback, ctx: UpdateContext, target_id, page):
     is_callback = isinstance(message_or_callback, types.CallbackQuery)
     message = message_or_callback.message if is_callback else message_or_callback
     
     t_name = "ГРУППЫ" if target_id != message.from_user.id else "Твои"
     
-    async with async_session() as session:
-        # Зона нужна только для расчета времени, в тексте не показываем
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res.scalar() or "Asia/Yekaterinburg"
-        
-        query = select(Task).where(Task.user_id == target_id).order_by(Task.id)
-        result = await session.execute(query)
-        all_tasks = result.scalars().all()
+    # Зона нужна только для расчета времени, в тексте не показываем
+    user_tz = await chat_settings.get_timezone(target_id)
+
+    async with ctx.db() as session:
+        # Для пагинатора нужно только количество, сами задачи грузим одной страницей
+        res = await session.execute(select(func.count()).select_from(Task).where(Task.user_id == target_id))
+        total_tasks = res.scalar()
 
-    if not all_tasks:
+        if total_tasks:
+            # Страница могла исчезнуть (удалили задачи) - показываем последнюю
+            page = max(1, min(page, math.ceil(total_tasks / ITEMS_PER_PAGE)))
+            start = (page - 1) * ITEMS_PER_PAGE
+            query = (
+                select(Task).where(Task.user_id == target_id)
+                .order_by(Task.id).limit(ITEMS_PER_PAGE).offset(start)
+            )
+            result = await session.execute(query)
+            page_tasks = result.scalars().all()
+
+    if not total_tasks:
         text = f"📋 <b>{t_name} задачи:</b>\n\nСписок пуст."
         if is_callback: await message.edit_text(text, parse_mode="HTML")
         else: await message.answer(text, parse_mode="HTML")
         return
-
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
-    page_tasks = all_tasks[start:end]
     
     # --- ИЗМЕНЕНИЕ ЗАГОЛОВКА ---
     page_info = f" (Стр {page})" if page > 1 else ""
@@ -114,10 +133,7 @@ async def show_list_page(message_or_callback, target_id, page):
         if task.is_active:
             status_icon = "" 
             try:
-                tz = pytz.timezone(user_tz if "Etc" not in user_tz else "UTC")
-                local_now = datetime.now(tz)
-                iter = croniter(task.cron_expression, local_now)
-                next_run = iter.get_next(datetime).astimezone(tz)
+                next_run = next_fire(task.cron_expression, user_tz)
                 time_info = f"🔜 {next_run.strftime('%d.%m %H:%M')}"
             except:
                 time_info = "🔜 ?"
@@ -145,7 +161,7 @@ async def show_list_page(message_or_callback, target_id, page):
             f"{type_icon} {text_preview}\n\n"
         )
     
-    kb = get_list_keyboard(len(all_tasks), page)
+    kb = get_list_keyboard(total_tasks, page, [task.id for task in page_tasks])
     
     if is_callback:
         await message.edit_text(response, reply_markup=kb, parse_mode="HTML")
@@ -155,31 +171,31 @@ async def show_list_page(message_or_callback, target_id, page):
 # ================= КОЛБЭКИ НАВИГАЦИИ =================
 
 @router.callback_query(F.data.startswith("list_page_"))
-async def callback_list_page(callback: types.CallbackQuery, state: FSMContext):
+async def callback_list_page(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
     page = int(callback.data.split("_")[2])
     target_id = await get_target_id(callback, state)
-    await show_list_page(callback, target_id, page)
+    await show_list_page(callback, ctx, target_id, page)
     await callback.answer()
 
 @router.callback_query(F.data == "list_back")
-async def callback_list_back(callback: types.CallbackQuery, state: FSMContext):
+async def callback_list_back(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
     target_id = await get_target_id(callback, state)
-    await show_list_page(callback, target_id, page=1)
+    await show_list_page(callback, ctx, target_id, page=1)
     await callback.answer()
 
 # ================= ПЕРЕХОД В КАРТОЧКУ ЗАДАЧИ =================
 
 @router.callback_query(F.data.startswith("list_select_"))
-async def callback_task_select(callback: types.CallbackQuery, state: FSMContext):
-    task_num = int(callback.data.split("_")[2])
+async def callback_task_select(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    task_num, task_id = parse_task_ref(callback.data)
     target_id = await get_target_id(callback, state)
     
-    async with async_session() as session:
-        task = await get_real_task_by_number(session, target_id, task_num)
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_num, task_id)
         if not task:
             await callback.answer("Задача не найдена (возможно, удалена).", show_alert=True)
             # Обновляем список
-            await show_list_page(callback, target_id, 1)
+            await show_list_page(callback, ctx, target_id, 1)
             return
         
         # Формируем Карточку
@@ -215,10 +231,11 @@ async def callback_task_select(callback: types.CallbackQuery, state: FSMContext)
             f"Статус: {status_text}\n"
             f"Расписание: {schedule_display}\n"
             f"{type_info}\n"
+            f"Пропущенные запуски: {MISFIRE_LABELS.get(task.misfire_policy, task.misfire_policy)}\n"
             f"📝 {text_full}"
         )
         
-        kb = get_task_keyboard(task_num, task.is_active)
+        kb = get_task_keyboard(task_num, task.id, task.is_active, task.misfire_policy)
         await callback.message.edit_text(card_text, reply_markup=kb, parse_mode="HTML")
     
     await callback.answer()
@@ -228,41 +245,61 @@ async def callback_task_select(callback: types.CallbackQuery, state: FSMContext)
 
 # --- PAUSE / RESUME ---
 @router.callback_query(F.data.startswith("task_pause_") | F.data.startswith("task_resume_"))
-async def callback_card_toggle(callback: types.CallbackQuery, state: FSMContext):
-    action, task_num = callback.data.split("_")[1], int(callback.data.split("_")[2])
-    target_id = await get_target_id(callback, state)
+async def callback_card_toggle(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    action = callback.data.split("_")[1]
+    task_num, task_id = parse_task_ref(callback.data)
+    target_id = await ctx.target_id()
+    # Для запуска нужна зона - берем до первого запроса в сессии (на промахе кэш сам пишет в users)
+    tz = await ctx.timezone() if action == "resume" else None
     
-    async with async_session() as session:
-        task = await get_real_task_by_number(session, target_id, task_num)
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_num, task_id)
         if not task: return
         
         if action == "pause":
             await pause_task(session, task.id, target_id)
+            await ctx.commit()
             await callback.answer("Задача на паузе ⏸")
         else:
-            # Нужна зона
-            res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-            tz = res.scalar() or "Asia/Yekaterinburg"
             await resume_task(callback.message.bot, session, task.id, target_id, tz)
+            await ctx.commit()
             await callback.answer("Задача запущена ▶️")
             
     # Обновляем карточку (перерисовываем статус и кнопки)
-    await callback_task_select(callback, state) 
+    await callback_task_select(callback, state, ctx) 
+
+# --- MISFIRE POLICY (по кругу: один раз -> все -> не отправлять) ---
+@router.callback_query(F.data.startswith("task_misfire_"))
+async def callback_card_misfire(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    task_num, task_id = parse_task_ref(callback.data)
+    target_id = await get_target_id(callback, state)
+
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_num, task_id)
+        if not task: return
+        order = ("once", "all", "skip")
+        current = task.misfire_policy if task.misfire_policy in order else "once"
+        policy = order[(order.index(current) + 1) % len(order)]
+        await set_misfire_policy(session, task.id, target_id, policy)
+        await ctx.commit()
+
+    await callback.answer(f"Пропущенные запуски: {MISFIRE_LABELS[policy]}")
+    await callback_task_select(callback, state, ctx)
 
 # --- SHARE ---
 @router.callback_query(F.data.startswith("task_share_"))
-async def callback_card_share(callback: types.CallbackQuery, state: FSMContext):
+async def callback_card_share(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext, bot_user: types.User):
     # ... (код получения token) ...
-    task_num = int(callback.data.split("_")[2])
+    task_num, task_id = parse_task_ref(callback.data)
     target_id = await get_target_id(callback, state)
     
-    async with async_session() as session:
-        task = await get_real_task_by_number(session, target_id, task_num)
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_num, task_id)
         if not task: return
         token = await create_share_snapshot(session, task.id)
+        await ctx.commit()
         
-        bot_username = (await callback.message.bot.get_me()).username
-        link = f"https://t.me/{bot_username}?start=share_{token}"
+        link = share_link(bot_user, token)
         
         encoded_text = get_share_text(task)
         
@@ -281,8 +318,8 @@ async def callback_card_share(callback: types.CallbackQuery, state: FSMContext):
 
 # --- EDIT ---
 @router.callback_query(F.data.startswith("task_edit_"))
-async def callback_card_edit(callback: types.CallbackQuery, state: FSMContext):
-    task_num = int(callback.data.split("_")[2])
+async def callback_card_edit(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    task_num, task_id = parse_task_ref(callback.data)
     
     # Удаляем карточку перед запуском меню
     await callback.message.delete()
@@ -290,33 +327,35 @@ async def callback_card_edit(callback: types.CallbackQuery, state: FSMContext):
     # Теперь вызываем меню (оно отправит новое сообщение)
     # Нам нужно передать message, который мы только что удалили? Нет, объект message остался в памяти.
     # Но start_editing_menu использует message.answer(). Это сработает.
-    await start_editing_menu(callback.message, state, task_num)
+    await start_editing_menu(callback.message, state, ctx, task_num, task_id)
     await callback.answer()
 
 # --- DELETE ---
 @router.callback_query(F.data.startswith("task_delete_confirm_"))
 async def callback_card_delete_ask(callback: types.CallbackQuery):
-    task_num = callback.data.split("_")[3]
+    task_num, task_id = parse_task_ref(callback.data)
+    ref = f"{task_num}_{task_id}" if task_id is not None else str(task_num)
     kb = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="🔥 ДА, Удалить", callback_data=f"task_delete_do_{task_num}")],
-        [types.InlineKeyboardButton(text="🔙 Нет, назад", callback_data=f"list_select_{task_num}")]
+        [types.InlineKeyboardButton(text="🔥 ДА, Удалить", callback_data=f"task_delete_do_{ref}")],
+        [types.InlineKeyboardButton(text="🔙 Нет, назад", callback_data=f"list_select_{ref}")]
     ])
     await callback.message.edit_text(f"⚠️ <b>Удалить задачу №{task_num}?</b>", reply_markup=kb, parse_mode="HTML")
     await callback.answer()
 
 @router.callback_query(F.data.startswith("task_delete_do_"))
-async def callback_card_delete_perform(callback: types.CallbackQuery, state: FSMContext):
-    task_num = int(callback.data.split("_")[3])
+async def callback_card_delete_perform(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    task_num, task_id = parse_task_ref(callback.data)
     target_id = await get_target_id(callback, state)
     
-    async with async_session() as session:
-        task = await get_real_task_by_number(session, target_id, task_num)
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_num, task_id)
         if task:
             await delete_task(session, task.id, target_id)
+            await ctx.commit()
             
     await callback.answer("Удалено 🗑")
     # Возвращаемся в список
-    await show_list_page(callback, target_id, 1)
+    await show_list_page(callback, ctx, target_id, 1)
 
 # --- BATCH ACTIONS (Меню "Всех") ---
 @router.callback_query(F.data == "list_batch_actions")
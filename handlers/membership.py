@@ -0,0 +1,28 @@
+from aiogram import Router, types
+
+from middlewares import admin_cache, ADMIN_STATUSES
+from services.delivery import delivery
+
+router = Router()
+
+# Статусы, при которых бот не может писать в чат
+GONE_STATUSES = ("kicked", "left")
+
+
+@router.my_chat_member()
+async def on_my_chat_member(event: types.ChatMemberUpdated):
+    """Бота заблокировали/удалили из группы - сразу ставим задачи чата на паузу, не дожидаясь ошибок"""
+    chat_id = event.chat.id
+    if event.new_chat_member.status in GONE_STATUSES:
+        delivery.mark_chat_gone(chat_id)
+    else:
+        delivery.mark_chat_back(chat_id)
+
+
+@router.chat_member()
+async def on_chat_member(event: types.ChatMemberUpdated):
+    """Кого-то повысили до админа или сняли с админки - сбрасываем кэш админов чата"""
+    was_admin = event.old_chat_member.status in ADMIN_STATUSES
+    is_admin = event.new_chat_member.status in ADMIN_STATUSES
+    if was_admin != is_admin:
+        admin_cache.invalidate(event.chat.id)
@@ -1,15 +1,10 @@
-from datetime import datetime
 from aiogram import Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select
-import pytz
-from croniter import croniter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from services.cron_manager import create_share_snapshot
 
-from database.base import async_session
-from database.models import User, Task
+from database.models import Task
 from services.cron_manager import (
     delete_task, edit_task, pause_task, resume_task, 
     pause_all_tasks, resume_all_tasks, delete_all_tasks, validate_cron
@@ -17,10 +12,11 @@ from services.cron_manager import (
 # Импортируем общие хелперы
 from handlers.common import (
     TaskStates, clear_state_keep_group, get_target_id, 
-    get_target_name, get_real_task_by_number, validate_time_format,
-    humanize_cron, get_share_text
+    get_target_name, get_real_task_by_number, resolve_task, validate_time_format,
+    humanize_cron, get_share_text, share_link
 )
 
+from middlewares import UpdateContext
 from keyboards import get_presets_keyboard, get_weekdays_keyboard, get_months_keyboard
 
 router = Router()
@@ -28,11 +24,11 @@ router = Router()
 # ================= ПАУЗА / СТАРТ (PAUSE / RESUME) =================
 
 @router.message(Command("pause"))
-async def cmd_pause(message: types.Message, state: FSMContext):
+async def cmd_pause(message: types.Message, state: FSMContext, ctx: UpdateContext):
     await clear_state_keep_group(state)
     args = message.text.split()
     if len(args) > 1 and args[1].isdigit():
-        await perform_pause(message, state, int(args[1]))
+        await perform_pause(message, state, ctx, int(args[1]))
         return
     
     t_name = await get_target_name(state)
@@ -46,28 +42,29 @@ async def cmd_pause(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_pause_id)
 
 @router.message(TaskStates.waiting_for_pause_id, ~F.text.startswith("/"))
-async def process_pause_id(message: types.Message, state: FSMContext):
+async def process_pause_id(message: types.Message, state: FSMContext, ctx: UpdateContext):
     if not message.text.isdigit(): return
-    await perform_pause(message, state, int(message.text))
+    await perform_pause(message, state, ctx, int(message.text))
     await clear_state_keep_group(state)
 
-async def perform_pause(message: types.Message, state: FSMContext, task_number: int):
+async def perform_pause(message: types.Message, state: FSMContext, ctx: UpdateContext, task_number: int):
     target_id = await get_target_id(message, state)
-    async with async_session() as session:
+    async with ctx.db() as session:
         task = await get_real_task_by_number(session, target_id, task_number)
         if not task:
             await message.answer(f"❌ Задача №{task_number} не найдена.")
             return
         await pause_task(session, task.id, target_id)
+        await ctx.commit()
     await message.answer(f"⏸ Задача №<b>{task_number}</b> на паузе.", parse_mode="HTML")
 
 # --- RESUME ---
 @router.message(Command("resume"))
-async def cmd_resume(message: types.Message, state: FSMContext):
+async def cmd_resume(message: types.Message, state: FSMContext, ctx: UpdateContext):
     await clear_state_keep_group(state)
     args = message.text.split()
     if len(args) > 1 and args[1].isdigit():
-        await perform_resume(message, state, int(args[1]))
+        await perform_resume(message, state, ctx, int(args[1]))
         return
     t_name = await get_target_name(state)
     
@@ -79,32 +76,32 @@ async def cmd_resume(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_resume_id)
 
 @router.message(TaskStates.waiting_for_resume_id, ~F.text.startswith("/"))
-async def process_resume_id(message: types.Message, state: FSMContext):
+async def process_resume_id(message: types.Message, state: FSMContext, ctx: UpdateContext):
     if not message.text.isdigit(): return
-    await perform_resume(message, state, int(message.text))
+    await perform_resume(message, state, ctx, int(message.text))
     await clear_state_keep_group(state)
 
-async def perform_resume(message: types.Message, state: FSMContext, task_number: int):
-    target_id = await get_target_id(message, state)
-    async with async_session() as session:
+async def perform_resume(message: types.Message, state: FSMContext, ctx: UpdateContext, task_number: int):
+    target_id = await ctx.target_id()
+    # Таймзона ЦЕЛИ - до первого запроса в сессии: на промахе кэш сам пишет в users
+    tz = await ctx.timezone()
+    async with ctx.db() as session:
         task = await get_real_task_by_number(session, target_id, task_number)
         if not task:
             await message.answer(f"❌ Задача №{task_number} не найдена.")
             return
-        # Получаем таймзону ЦЕЛИ
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        tz = res.scalar() or "Asia/Yekaterinburg"
         await resume_task(message.bot, session, task.id, target_id, tz)
+        await ctx.commit()
     await message.answer(f"✅ Задача №<b>{task_number}</b> запущена!", parse_mode="HTML")
 
 # ================= УДАЛЕНИЕ (DELETE) =================
 
 @router.message(Command("delete"))
-async def cmd_delete(message: types.Message, state: FSMContext):
+async def cmd_delete(message: types.Message, state: FSMContext, ctx: UpdateContext):
     await clear_state_keep_group(state)
     args = message.text.split()
     if len(args) > 1 and args[1].isdigit():
-        await perform_delete(message, state, int(args[1]))
+        await perform_delete(message, state, ctx, int(args[1]))
         return
     t_name = await get_target_name(state)
     
@@ -116,19 +113,20 @@ async def cmd_delete(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_delete_id)
 
 @router.message(TaskStates.waiting_for_delete_id, ~F.text.startswith("/"))
-async def process_delete_id(message: types.Message, state: FSMContext):
+async def process_delete_id(message: types.Message, state: FSMContext, ctx: UpdateContext):
     if not message.text.isdigit(): return
-    await perform_delete(message, state, int(message.text))
+    await perform_delete(message, state, ctx, int(message.text))
     await clear_state_keep_group(state)
 
-async def perform_delete(message: types.Message, state: FSMContext, task_number: int):
+async def perform_delete(message: types.Message, state: FSMContext, ctx: UpdateContext, task_number: int):
     target_id = await get_target_id(message, state)
-    async with async_session() as session:
+    async with ctx.db() as session:
         task = await get_real_task_by_number(session, target_id, task_number)
         if not task:
             await message.answer(f"❌ Задача №{task_number} не найдена.")
             return
         success = await delete_task(session, task.id, target_id)
+        await ctx.commit()
     if success: await message.answer(f"✅ Задача №<b>{task_number}</b> удалена.", parse_mode="HTML")
     else: await message.answer("❌ Ошибка при удалении.")
 
@@ -137,26 +135,26 @@ async def perform_delete(message: types.Message, state: FSMContext, task_number:
 
 # 1. Вход в команду
 @router.message(Command("edit"))
-async def cmd_edit(message: types.Message, state: FSMContext):
+async def cmd_edit(message: types.Message, state: FSMContext, ctx: UpdateContext):
     await clear_state_keep_group(state)
     args = message.text.split()
     if len(args) > 1 and args[1].isdigit():
-        await start_editing_menu(message, state, int(args[1]))
+        await start_editing_menu(message, state, ctx, int(args[1]))
         return
     t_name = await get_target_name(state)
     await message.answer(f"Введите <b>номер</b> задачи для редактирования{t_name}:", parse_mode="HTML")
     await state.set_state(TaskStates.waiting_for_edit_id)
 
 @router.message(TaskStates.waiting_for_edit_id, ~F.text.startswith("/"))
-async def process_edit_id_input(message: types.Message, state: FSMContext):
+async def process_edit_id_input(message: types.Message, state: FSMContext, ctx: UpdateContext):
     if not message.text.isdigit(): return
-    await start_editing_menu(message, state, int(message.text))
+    await start_editing_menu(message, state, ctx, int(message.text))
 
-async def start_editing_menu(message: types.Message, state: FSMContext, task_number: int):
+async def start_editing_menu(message: types.Message, state: FSMContext, ctx: UpdateContext, task_number: int, task_id: int | None = None):
     target_id = await get_target_id(message, state)
     
-    async with async_session() as session:
-        task = await get_real_task_by_number(session, target_id, task_number)
+    async with ctx.db() as session:
+        task = await resolve_task(session, target_id, task_number, task_id)
         if not task:
             await message.answer(f"❌ Задача №{task_number} не найдена.")
             await clear_state_keep_group(state)
@@ -227,13 +225,13 @@ async def process_edit_action(callback: types.CallbackQuery, state: FSMContext):
 
 # --- ВЕТКА: ИЗМЕНЕНИЕ ТЕКСТА ---
 @router.message(TaskStates.editing_text_input, ~F.text.startswith("/"))
-async def process_new_text(message: types.Message, state: FSMContext):
+async def process_new_text(message: types.Message, state: FSMContext, ctx: UpdateContext):
     new_text = message.text
     data = await state.get_data()
     # Оставляем старый крон
     final_cron = data['old_cron']
     
-    await finalize_edit(message, state, final_cron, new_text)
+    await finalize_edit(message, state, ctx, final_cron, new_text)
 
 
 # --- ВЕТКА: ИЗМЕНЕНИЕ ВРЕМЕНИ (Пресеты) ---
@@ -319,7 +317,7 @@ async def process_edit_day_month(message: types.Message, state: FSMContext):
 
 # Логика времени и генерации Крона (копия)
 @router.message(TaskStates.editing_time_input, ~F.text.startswith("/"))
-async def process_edit_time(message: types.Message, state: FSMContext):
+async def process_edit_time(message: types.Message, state: FSMContext, ctx: UpdateContext):
     time_str = message.text.strip()
     
     # Используем функцию из common.py
@@ -348,11 +346,11 @@ async def process_edit_time(message: types.Message, state: FSMContext):
     # Сохраняем! Текст оставляем старый (берем из сохраненного при старте edit)
     old_text = data.get('old_text', "")
     
-    await finalize_edit(message, state, cron_res, old_text)
+    await finalize_edit(message, state, ctx, cron_res, old_text)
 
 # Логика ручного крона
 @router.message(TaskStates.editing_cron_input, ~F.text.startswith("/"))
-async def process_edit_manual_cron(message: types.Message, state: FSMContext):
+async def process_edit_manual_cron(message: types.Message, state: FSMContext, ctx: UpdateContext):
     new_cron = message.text.strip()
     is_valid, err = validate_cron(new_cron)
     if not is_valid:
@@ -361,22 +359,20 @@ async def process_edit_manual_cron(message: types.Message, state: FSMContext):
     
     data = await state.get_data()
     old_text = data['old_text']
-    await finalize_edit(message, state, new_cron, old_text)
+    await finalize_edit(message, state, ctx, new_cron, old_text)
 
 
 # --- ФИНАЛИЗАЦИЯ (Сохранение в БД) ---
-async def finalize_edit(message: types.Message, state: FSMContext, new_cron: str, new_text: str):
+async def finalize_edit(message: types.Message, state: FSMContext, ctx: UpdateContext, new_cron: str, new_text: str):
     data = await state.get_data()
     task_id = data['editing_task_id']
     task_num = data['editing_task_number']
     
-    target_id = await get_target_id(message, state)
+    target_id = await ctx.target_id()
+    # Нужна таймзона для перезапуска планировщика (до сессии: на промахе кэш сам пишет в users)
+    user_tz = await ctx.timezone()
     
-    async with async_session() as session:
-        # Нужна таймзона для перезапуска планировщика
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res.scalar() or "Asia/Yekaterinburg"
-        
+    async with ctx.db() as session:
         try:
             await edit_task(
                 bot=message.bot, 
@@ -387,17 +383,19 @@ async def finalize_edit(message: types.Message, state: FSMContext, new_cron: str
                 text=new_text, 
                 timezone_str=user_tz
             )
+            await ctx.commit()
             await message.answer(f"✅ Задача №<b>{task_num}</b> успешно обновлена!", parse_mode="HTML")
         except Exception as e:
+            await ctx.rollback()
             await message.answer(f"❌ Ошибка обновления: {e}")
             
     await clear_state_keep_group(state)
 
 
 # --- ОБНОВЛЕННЫЙ START_EDITING ---
-async def start_editing(message: types.Message, state: FSMContext, task_number: int):
+async def start_editing(message: types.Message, state: FSMContext, ctx: UpdateContext, task_number: int):
     target_id = await get_target_id(message, state)
-    async with async_session() as session:
+    async with ctx.db() as session:
         task = await get_real_task_by_number(session, target_id, task_number)
         if not task:
             await message.answer(f"❌ Задача №{task_number} не найдена.")
@@ -439,7 +437,7 @@ async def process_edit_cron(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.editing_text)
 
 @router.message(TaskStates.editing_text, ~F.text.startswith("/"))
-async def process_edit_text(message: types.Message, state: FSMContext):
+async def process_edit_text(message: types.Message, state: FSMContext, ctx: UpdateContext):
     data = await state.get_data()
     input_text = message.text.strip()
     final_text = data['old_text'] if input_text == "." else message.text
@@ -448,16 +446,17 @@ async def process_edit_text(message: types.Message, state: FSMContext):
     task_num = data.get('editing_task_number', '?')
     
     # Важно: берем target_id (группа или юзер)
-    target_id = await get_target_id(message, state)
+    target_id = await ctx.target_id()
+    user_tz = await ctx.timezone()
 
-    async with async_session() as session:
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        user_tz = res.scalar() or "Asia/Yekaterinburg"
+    async with ctx.db() as session:
         try:
             await edit_task(bot=message.bot, session=session, task_id=task_id, user_id=target_id, 
                             cron_exp=data['final_cron'], text=final_text, timezone_str=user_tz)
+            await ctx.commit()
             await message.answer(f"✅ Задача №<b>{task_num}</b> обновлена!", parse_mode="HTML")
         except Exception as e:
+            await ctx.rollback()
             await message.answer(f"❌ Ошибка обновления: {e}")
     
     await clear_state_keep_group(state)
@@ -465,13 +464,13 @@ async def process_edit_text(message: types.Message, state: FSMContext):
 # ================= ШАРИНГ (SHARE) =================
 
 @router.message(Command("share"))
-async def cmd_share(message: types.Message, state: FSMContext):
+async def cmd_share(message: types.Message, state: FSMContext, ctx: UpdateContext, bot_user: types.User):
     await clear_state_keep_group(state)
     args = message.text.split()
     
     # Если аргумент есть (/share 1)
     if len(args) > 1 and args[1].isdigit():
-        await perform_share(message, state, int(args[1]))
+        await perform_share(message, state, ctx, bot_user, int(args[1]))
         return
         
     t_name = await get_target_name(state)
@@ -479,15 +478,15 @@ async def cmd_share(message: types.Message, state: FSMContext):
     await state.set_state(TaskStates.waiting_for_share_id) # <-- Добавь это состояние в common.py!
 
 @router.message(TaskStates.waiting_for_share_id, ~F.text.startswith("/"))
-async def process_share_id(message: types.Message, state: FSMContext):
+async def process_share_id(message: types.Message, state: FSMContext, ctx: UpdateContext, bot_user: types.User):
     if not message.text.isdigit(): return
-    await perform_share(message, state, int(message.text))
+    await perform_share(message, state, ctx, bot_user, int(message.text))
     await clear_state_keep_group(state)
 
-async def perform_share(message: types.Message, state: FSMContext, task_number: int):
+async def perform_share(message: types.Message, state: FSMContext, ctx: UpdateContext, bot_user: types.User, task_number: int):
     target_id = await get_target_id(message, state)
     
-    async with async_session() as session:
+    async with ctx.db() as session:
         # Ищем задачу, чтобы проверить, что она существует и принадлежит юзеру
         task = await get_real_task_by_number(session, target_id, task_number)
         if not task:
@@ -496,9 +495,9 @@ async def perform_share(message: types.Message, state: FSMContext, task_number:
         
         # СОЗДАЕМ СНЕПШОТ (Независимая ссылка)
         token = await create_share_snapshot(session, task.id)
+        await ctx.commit()
             
-        bot_username = (await message.bot.get_me()).username
-        link = f"https://t.me/{bot_username}?start=share_{token}"
+        link = share_link(bot_user, token)
         
         encoded_text = get_share_text(task)
         
@@ -517,48 +516,48 @@ async def perform_share(message: types.Message, state: FSMContext, task_number:
 # --- ОБРАБОТКА КНОПОК "ВСЕХ" ---
 
 @router.callback_query(F.data == "btn_pause_all")
-async def callback_pause_all(callback: types.CallbackQuery, state: FSMContext):
-    # 1. Определяем правильный ID
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
-    target_id = group_id if group_id else callback.from_user.id # <-- БЕРЕМ ID ЮЗЕРА, А НЕ БОТА
+async def callback_pause_all(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    # 1. Определяем правильный ID (ID юзера, а не бота)
+    target_id = await ctx.target_id()
     
-    async with async_session() as session:
+    async with ctx.db() as session:
         await pause_all_tasks(session, target_id)
+        await ctx.commit()
     
     await callback.message.edit_text("⏸ <b>Все задачи поставлены на паузу.</b>", parse_mode="HTML")
     await clear_state_keep_group(state)
 
 @router.callback_query(F.data == "btn_resume_all")
-async def callback_resume_all(callback: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
-    target_id = group_id if group_id else callback.from_user.id
+async def callback_resume_all(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    target_id = await ctx.target_id()
+    tz = await ctx.timezone()
     
-    async with async_session() as session:
-        res = await session.execute(select(User.timezone).where(User.user_id == target_id))
-        tz = res.scalar() or "Asia/Yekaterinburg"
-        await resume_all_tasks(callback.message.bot, session, target_id, tz)
+    async with ctx.db() as session:
+        errors = await resume_all_tasks(callback.message.bot, session, target_id, tz)
+        await ctx.commit()
     
-    await callback.message.edit_text("✅ <b>Все задачи запущены!</b>", parse_mode="HTML")
+    text = "✅ <b>Все задачи запущены!</b>"
+    if errors:
+        text += f"\n\n⚠️ Не удалось запустить задач: {len(errors)} (проверьте их расписание)."
+    await callback.message.edit_text(text, parse_mode="HTML")
     await clear_state_keep_group(state)
 
 @router.callback_query(F.data == "confirm_delete_all")
-async def callback_confirm_delete_all(callback: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    group_id = data.get("active_group_id")
-    target_id = group_id if group_id else callback.from_user.id
+async def callback_confirm_delete_all(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
+    target_id = await ctx.target_id()
     
-    async with async_session() as session:
+    async with ctx.db() as session:
         await delete_all_tasks(session, target_id)
+        await ctx.commit()
     await callback.message.edit_text("🗑 <b>Все задачи удалены.</b>", parse_mode="HTML")
     await clear_state_keep_group(state)
 
 @router.callback_query(F.data == "confirm_delete_all")
-async def callback_confirm_delete_all(callback: types.CallbackQuery, state: FSMContext):
+async def callback_confirm_delete_all(callback: types.CallbackQuery, state: FSMContext, ctx: UpdateContext):
     target_id = await get_target_id(callback, state)
-    async with async_session() as session:
+    async with ctx.db() as session:
         await delete_all_tasks(session, target_id)
+        await ctx.commit()
     await callback.message.edit_text("🗑 <b>Все задачи удалены.</b>", parse_mode="HTML")
     await clear_state_keep_group(state)
 
@@ -1,28 +1,67 @@
 import asyncio
 import logging
-import os
-from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommand
-from middlewares import AdminOnlyMiddleware
-from services.cron_manager import scheduler, restore_tasks
-from database.base import init_db
+from config import BOT_TOKEN, BOT_MODE, BOT_REPLICAS, UPDATES_CONCURRENCY, SCHEDULER_MODE, FSM_CACHE_SIZE
+from middlewares import AdminOnlyMiddleware, UpdateContextMiddleware
+from services.cron_manager import restore_tasks
+from services.scheduling import backend
+from services.delivery import delivery
+from services.outbox import outbox
+from services.fsm_storage import fsm_storage
+from database.base import init_db, engine
 from handlers import router
+from webhook import run_webhook
+
+logger = logging.getLogger(__name__)
+
+
+def log_restore_result(task: asyncio.Task):
+    """Без восстановления джобы не зарегистрированы и напоминания не уходят - ошибку пишем в лог сразу"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Не удалось восстановить задачи", exc_info=task.exception())
+
+
+def check_replicas():
+    """
+    Несколько экземпляров на одной базе. Джобы APScheduler (fanout/jobs) и кэш задач живут в памяти
+    своего процесса: пауза или удаление через одну реплику не дошли бы до другой, и та слала бы старое.
+    Режим db читает расписание и содержимое из таблицы tasks, дубли срабатываний отсекает outbox
+    """
+    if BOT_REPLICAS <= 1: return
+    problems = []
+    if BOT_MODE != "webhook":
+        problems.append("BOT_MODE=webhook (getUpdates не делится между экземплярами)")
+    if SCHEDULER_MODE != "db":
+        problems.append("SCHEDULER_MODE=db")
+    if FSM_CACHE_SIZE != 0:
+        problems.append("FSM_CACHE_SIZE=0")
+    if problems:
+        raise ValueError(f"BOT_REPLICAS={BOT_REPLICAS}: нужны " + ", ".join(problems))
 
-load_dotenv()
-TOKEN = os.getenv("BOT_TOKEN")
 
 async def main():
     logging.basicConfig(level=logging.INFO)
+    check_replicas()
     
-    bot = Bot(token=TOKEN)
-    dp = Dispatcher()
+    bot = Bot(token=BOT_TOKEN)
+    # Профиль бота не меняется за время работы: берем один раз, хендлеры получают его как bot_user
+    bot_user = await bot.get_me()
+    # Состояния FSM в БД: диалоги и режим группы переживают рестарт
+    dp = Dispatcher(storage=fsm_storage, bot_user=bot_user)
+    # FSM и цель (юзер/группа) - один раз на апдейт; должен идти после FSMContextMiddleware диспетчера
+    dp.update.outer_middleware(UpdateContextMiddleware())
     dp.message.middleware(AdminOnlyMiddleware())
     dp.include_router(router)
 
     await init_db()
-    scheduler.start()
-    await restore_tasks(bot)
+    outbox.start()
+    fsm_storage.start()
+    delivery.start(bot)
+    backend.start()
+    # Восстанавливаем фоном: бот отвечает пользователям сразу
+    restore = asyncio.create_task(restore_tasks(bot))
+    restore.add_done_callback(log_restore_result)
 
     # --- УСТАНОВКА МЕНЮ КОМАНД ---
     commands = [
@@ -37,10 +76,29 @@ async def main():
     await bot.set_my_commands(commands)
     # -----------------------------
 
-    print("🤖 Бот запущен...")
+    print(f"🤖 Бот запущен ({BOT_MODE})...")
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        elif BOT_MODE == "polling":
+            # Пока зарегистрирован вебхук, getUpdates не работает - снимаем его (апдейты не теряются)
+            await bot.delete_webhook()
+            # Явно просим все типы апдейтов, на которые есть хендлеры: chat_member по умолчанию не приходит
+            await dp.start_polling(
+                bot, allowed_updates=dp.resolve_used_update_types(), tasks_concurrency_limit=UPDATES_CONCURRENCY
+            )
+        else:
+            raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE}")
     finally:
+        restore.cancel()
+        # Ошибку (если была) уже записал log_restore_result
+        await asyncio.gather(restore, return_exceptions=True)
+        await backend.shutdown()
+        await delivery.stop()
+        await outbox.stop()
+        await fsm_storage.close()
+        # Закрываем соединения: SQLite при этом переносит WAL в основной файл
+        await engine.dispose()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -1,5 +1,80 @@
-from aiogram import BaseMiddleware
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Mapping
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
 from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL
+from database.base import async_session, commit, rollback
+from services.chat_settings import chat_settings
+
+# Статусы участника с правами админа
+ADMIN_STATUSES = ("administrator", "creator")
+
+
+class AdminCache:
+    """
+    Кэш админов групп: chat_id -> множество user_id, заполняется одним getChatAdministrators.
+    Параллельные запросы по одному чату ждут один и тот же вызов API.
+    """
+
+    def __init__(self, maxsize: int = ADMIN_CACHE_SIZE, ttl: float = ADMIN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # chat_id -> (id админов, когда истекает)
+        self._items: OrderedDict[int, tuple[frozenset[int], float]] = OrderedDict()
+        # chat_id -> идущий запрос к API
+        self._loading: dict[int, asyncio.Future] = {}
+
+    async def is_admin(self, bot: Bot, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.get_admins(bot, chat_id)
+
+    async def get_admins(self, bot: Bot, chat_id: int) -> frozenset[int]:
+        item = self._items.get(chat_id)
+        if item is not None and item[1] > time.monotonic():
+            self._items.move_to_end(chat_id)
+            return item[0]
+
+        future = self._loading.get(chat_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(bot, chat_id))
+            self._loading[chat_id] = future
+            future.add_done_callback(lambda f: self._forget(chat_id, f))
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(future)
+
+    def invalidate(self, chat_id: int):
+        self._items.pop(chat_id, None)
+        # Идущий запрос мог уже получить старый список: следующий вызов сделает новый
+        self._loading.pop(chat_id, None)
+
+    def _forget(self, chat_id: int, future: asyncio.Future):
+        if self._loading.get(chat_id) is future:
+            del self._loading[chat_id]
+
+    async def _load(self, bot: Bot, chat_id: int) -> frozenset[int]:
+        admins = frozenset(member.user.id for member in await bot.get_chat_administrators(chat_id))
+        # Пока шел запрос, кэш могли сбросить (chat_member) - тогда список мог устареть, не сохраняем
+        if self._loading.get(chat_id) is asyncio.current_task():
+            self._items[chat_id] = (admins, time.monotonic() + self.ttl)
+            self._items.move_to_end(chat_id)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return admins
+
+    def __len__(self):
+        return len(self._items)
+
+
+admin_cache = AdminCache()
+
 
 class AdminOnlyMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: Message, data: dict):
@@ -18,11 +93,148 @@ class AdminOnlyMiddleware(BaseMiddleware):
                 command = text.split()[0].split("@")[0] # /add@bot -> /add
                 
                 if command not in public_commands:
-                    # Проверяем права
-                    member = await event.bot.get_chat_member(event.chat.id, event.from_user.id)
-                    if member.status not in ["administrator", "creator"]:
+                    # Проверяем права (список админов чата - из кэша)
+                    if not await admin_cache.is_admin(event.bot, event.chat.id, event.from_user.id):
                         await event.answer("⛔️ Эта команда доступна только администраторам.")
                         return # Прерываем выполнение, хендлер не сработает
         
         # Если всё ок - пропускаем дальше
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+
+# ================= КОНТЕКСТ АПДЕЙТА =================
+
+_UNSET = object()
+
+
+class CachedFSMContext(FSMContext):
+    """
+    FSMContext на время одного апдейта: состояние и данные читаются из хранилища один раз,
+    дальше - из памяти. Записи сразу уходят в хранилище.
+    """
+
+    def __init__(self, state: FSMContext, raw_state: Any = _UNSET):
+        super().__init__(storage=state.storage, key=state.key)
+        # Состояние уже прочитал FSMContextMiddleware (raw_state) - второй раз не читаем
+        self._state = raw_state
+        self._data: dict[str, Any] | None = None
+
+    async def get_state(self) -> str | None:
+        if self._state is _UNSET:
+            self._state = await super().get_state()
+        return self._state
+
+    async def set_state(self, state: StateType = None) -> None:
+        await super().set_state(state)
+        self._state = state.state if isinstance(state, State) else state
+
+    async def get_data(self) -> dict[str, Any]:
+        if self._data is None:
+            self._data = await super().get_data()
+        return self._data.copy()
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        await super().set_data(data)
+        self._data = dict(data)
+
+    async def get_value(self, key: str, default: Any | None = None) -> Any | None:
+        return (await self.get_data()).get(key, default)
+
+    async def update_data(self, data: Mapping[str, Any] | None = None, **kwargs: Any) -> dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self.get_data()
+        current.update(kwargs)
+        await self.set_data(current)
+        return current.copy()
+
+
+class UpdateContext:
+    """
+    Все, что хендлеру нужно про "кого обслуживаем" в этом апдейте:
+    цель (группа в режиме группы или сам пользователь), ее часовой пояс и сессия БД.
+    Пояс и сессия берутся только при первом обращении.
+
+    Сессия - единица работы апдейта: одна транзакция на все блоки ctx.db(), коммит один раз
+    (ctx.commit() в хендлере, если нужно ответить по его результату, иначе - middleware в конце).
+    Планировщик и кэши меняются после коммита (on_commit), при ошибке все откатывается.
+    """
+
+    def __init__(self, state: CachedFSMContext, user_id: int):
+        self.state = state
+        self.user_id = user_id
+        self._timezone: tuple[int, str] | None = None # (target_id, пояс)
+        self._session: AsyncSession | None = None
+
+    async def target_id(self) -> int:
+        """ID группы (если мы в режиме группы) или ID юзера"""
+        return (await self.state.get_value("active_group_id")) or self.user_id
+
+    async def is_group_mode(self) -> bool:
+        return await self.target_id() != self.user_id
+
+    async def timezone(self) -> str:
+        """Пояс цели. Заодно создает запись чата в users, если ее еще нет"""
+        target_id = await self.target_id()
+        # Цель могла смениться внутри апдейта (вход в режим группы) - тогда читаем заново
+        if self._timezone is None or self._timezone[0] != target_id:
+            self._timezone = (target_id, await chat_settings.get_timezone(target_id))
+        return self._timezone[1]
+
+    def invalidate_timezone(self):
+        self._timezone = None
+
+    def session(self) -> AsyncSession:
+        """Сессия БД на весь апдейт: открывается при первом вызове, закрывается middleware"""
+        if self._session is None:
+            self._session = async_session()
+        return self._session
+
+    @asynccontextmanager
+    async def db(self):
+        """
+        async with ctx.db() as session - замена async with async_session():
+        та же сессия апдейта, выход из блока не коммитит и не закрывает ее
+        """
+        yield self.session()
+
+    async def commit(self):
+        """Коммит единицы работы и отложенные эффекты. Без изменений - ничего не пишет"""
+        if self._session is not None:
+            await commit(self._session)
+
+    async def rollback(self):
+        if self._session is not None:
+            await rollback(self._session)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """
+    Подменяет state на CachedFSMContext и кладет в данные хендлера ctx: UpdateContext.
+    Вешается на dp.update.outer_middleware - после FSMContextMiddleware, который создает state.
+    """
+
+    async def __call__(self, handler, event, data: dict):
+        state = data.get("state")
+        user = data.get("event_from_user")
+        if state is None or user is None:
+            return await handler(event, data)
+
+        cached = CachedFSMContext(state, data.get("raw_state", _UNSET))
+        ctx = UpdateContext(cached, user.id)
+        data["state"] = cached
+        data["ctx"] = ctx
+        try:
+            result = await handler(event, data)
+            await ctx.commit()
+            return result
+        except BaseException:
+            await ctx.rollback()
+            raise
+        finally:
+            await ctx.close()
@@ -0,0 +1,285 @@
+"""
+Форматы бэкапа задач:
+- txt: блоки "cron\\nтекст", разделенные строкой ==========, медиа - префикс текста [type:file_id].
+  Старый формат; текст, в котором есть разделитель, обратно не прочитается.
+- ndjson: одна задача - один JSON-объект на строку, со всеми полями (is_active, misfire_policy...).
+- gz: тот же ndjson, сжатый gzip.
+Экспорт и импорт читают/пишут потоком, без сборки всего бэкапа в памяти.
+"""
+import asyncio
+import gzip
+import itertools
+import json
+import re
+import tempfile
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert, update, select
+
+from database.base import async_session
+from database.models import Task
+from services.cron import normalize_cron, validate_cron, utcnow
+from services.scheduling import backend, next_run_utc, MISFIRE_POLICIES, DEFAULT_MISFIRE_POLICY
+
+SEPARATOR = "=========="
+# [photo:AgAC...] Доброе утро
+MEDIA_RE = re.compile(r"^\[(\w+):(.+?)\]\s?(.*)", re.DOTALL)
+# Сколько задач вставлять одним executemany
+IMPORT_CHUNK = 1000
+# Разобранный импорт держим в памяти до этого размера (байт), дальше - во временном файле
+IMPORT_SPOOL_SIZE = 4 * 1024 * 1024
+# Сколько строк экспорта тянуть из БД за раз
+EXPORT_CHUNK = 1000
+
+# Формат -> расширение файла
+EXPORT_FORMATS = {"txt": "txt", "ndjson": "ndjson", "gz": "ndjson.gz"}
+DEFAULT_EXPORT_FORMAT = "txt"
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Поля задачи в бэкапе (порядок - как в ndjson)
+EXPORT_COLUMNS = (
+    Task.cron_expression, Task.message_text, Task.content_type,
+    Task.file_id, Task.is_active, Task.misfire_policy,
+)
+
+
+# --- ЭКСПОРТ ---
+
+def format_block(row) -> str:
+    """Задача -> блок txt. Если есть медиа -> [photo:Age...] Текст"""
+    content_prefix = ""
+    if row.content_type != "text" and row.file_id:
+        content_prefix = f"[{row.content_type}:{row.file_id}] "
+    return f"{row.cron_expression}\n{content_prefix}{row.message_text or ''}"
+
+
+def format_record(row) -> str:
+    """Задача -> строка ndjson"""
+    return json.dumps({
+        "cron": row.cron_expression,
+        "text": row.message_text or "",
+        "content_type": row.content_type or "text",
+        "file_id": row.file_id,
+        "is_active": bool(row.is_active),
+        "misfire_policy": row.misfire_policy,
+    }, ensure_ascii=False) + "\n"
+
+
+async def export_tasks(user_id: int, fmt: str, out) -> int:
+    """
+    Пишет задачи чата в бинарный файл out в формате fmt, читая БД пачками (yield_per).
+    Возвращает число задач
+    """
+    if fmt == "gz":
+        # Закрывает только gzip-обертку, сам out остается открытым
+        with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+            return await export_tasks(user_id, "ndjson", gz)
+
+    count = 0
+    query = (
+        select(*EXPORT_COLUMNS).where(Task.user_id == user_id).order_by(Task.id)
+        .execution_options(yield_per=EXPORT_CHUNK)
+    )
+    async with async_session() as session:
+        result = await session.stream(query)
+        async for row in result:
+            if fmt == "txt":
+                chunk = format_block(row) if not count else f"\n{SEPARATOR}\n{format_block(row)}"
+            else:
+                chunk = format_record(row)
+            out.write(chunk.encode("utf-8"))
+            count += 1
+    return count
+
+
+# --- ИМПОРТ ---
+
+def iter_blocks(lines):
+    """
+    Режет поток строк на блоки по разделителю, не читая весь файл в память.
+    Отдает (номер блока, текст блока); нумерация как у text.split(SEPARATOR)
+    """
+    buf = []
+    index = 1
+    for line in lines:
+        *finished, rest = line.split(SEPARATOR)
+        for part in finished:
+            buf.append(part)
+            yield index, "".join(buf)
+            index += 1
+            buf = []
+        buf.append(rest)
+    yield index, "".join(buf)
+
+
+def parse_block(block: str) -> dict:
+    """Блок txt -> поля задачи. Бросает ValueError с причиной для отчета"""
+    lines = block.strip().split("\n", 1)
+    if len(lines) < 2:
+        raise ValueError("Нет текста")
+
+    cron_exp = lines[0].strip()
+    text = lines[1].strip()
+    c_type = "text"
+    f_id = None
+    match = MEDIA_RE.match(text)
+    if match:
+        c_type, f_id, text = match.groups()
+
+    is_valid, _ = validate_cron(cron_exp)
+    if not is_valid:
+        raise ValueError("Неверный Cron")
+    return {"cron_expression": normalize_cron(cron_exp), "message_text": text, "content_type": c_type, "file_id": f_id}
+
+
+def parse_record(line: str) -> dict:
+    """Строка ndjson -> поля задачи. Бросает ValueError с причиной для отчета"""
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        raise ValueError("Не JSON")
+    if not isinstance(data, dict):
+        raise ValueError("Не объект")
+
+    cron_exp = data.get("cron")
+    text = data.get("text") or ""
+    file_id = data.get("file_id")
+    if not isinstance(text, str):
+        raise ValueError("Текст не строка")
+    # Медиа может быть без подписи ("Оставить без текста"), текстовая задача - нет
+    if not file_id and not text.strip():
+        raise ValueError("Нет текста")
+    is_valid, _ = validate_cron(cron_exp) if isinstance(cron_exp, str) else (False, None)
+    if not is_valid:
+        raise ValueError("Неверный Cron")
+    is_active = data.get("is_active", True)
+    # bool("false") == True: строку или число не угадываем, а отклоняем
+    if not isinstance(is_active, bool):
+        raise ValueError("is_active не true/false")
+    policy = data.get("misfire_policy") or DEFAULT_MISFIRE_POLICY
+    if policy not in MISFIRE_POLICIES:
+        raise ValueError(f"Неизвестная политика: {policy}")
+
+    return {
+        "cron_expression": normalize_cron(cron_exp),
+        "message_text": text,
+        "content_type": (data.get("content_type") or "text") if file_id else "text",
+        "file_id": file_id,
+        "is_active": is_active,
+        "misfire_policy": policy,
+    }
+
+
+def iter_records(lines):
+    """Строки ndjson (пустые пропускаем). Отдает (номер строки, строка)"""
+    for index, line in enumerate(lines, 1):
+        if line.strip():
+            yield index, line
+
+
+# Формат -> (разбивка на записи, разбор записи, как называть запись в отчете)
+IMPORT_FORMATS = {
+    "txt": (iter_blocks, parse_block, "Блок"),
+    "ndjson": (iter_records, parse_record, "Строка"),
+}
+
+
+def sniff_format(lines):
+    """
+    Определяет формат по первой непустой строке: ndjson начинается с "{".
+    Возвращает (формат, строки) - прочитанное начало возвращается в поток
+    """
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip():
+            fmt = "ndjson" if line.lstrip().startswith("{") else "txt"
+            return fmt, itertools.chain(head, lines)
+    return "txt", iter(head)
+
+
+def open_upload(raw):
+    """Бинарный файл бэкапа (txt, ndjson или gz) -> бинарный поток без сжатия"""
+    magic = raw.read(2)
+    raw.seek(0)
+    return gzip.GzipFile(fileobj=raw, mode="rb") if magic == GZIP_MAGIC else raw
+
+
+async def _insert_chunk(session, rows: list[dict]) -> list[tuple]:
+    stmt = insert(Task).returning(
+        Task.id, Task.cron_expression, Task.is_active, Task.misfire_policy, sort_by_parameter_order=True
+    )
+    return [tuple(row) for row in await session.execute(stmt, rows)]
+
+
+def _spool_rows(lines, timezone_str: str, spool) -> list[str]:
+    """
+    Разбирает и проверяет весь бэкап, не трогая БД: годные задачи - строками JSON в spool.
+    Возвращает ошибки по записям
+    """
+    fmt, lines = sniff_format(lines)
+    split, parse, label = IMPORT_FORMATS[fmt]
+    errors = []
+    for index, entry in split(lines):
+        if not entry.strip(): continue
+        try:
+            row = parse(entry)
+            row.setdefault("is_active", True)
+            row.setdefault("misfire_policy", DEFAULT_MISFIRE_POLICY)
+            # Для задач на паузе next_run_at посчитает resume_task
+            next_at = next_run_utc(row["cron_expression"], timezone_str) if row["is_active"] else None
+        except ValueError as e:
+            errors.append(f"{label} {index}: {e}")
+            continue
+        row["next_run_at"] = next_at.isoformat() if next_at else None
+        spool.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return errors
+
+
+def _read_spool(spool):
+    """Пачки по IMPORT_CHUNK задач из spool"""
+    spool.seek(0)
+    while True:
+        rows = [json.loads(line) for line in itertools.islice(spool, IMPORT_CHUNK)]
+        if not rows: return
+        for row in rows:
+            if row["next_run_at"]:
+                row["next_run_at"] = datetime.fromisoformat(row["next_run_at"])
+        yield rows
+
+
+async def import_tasks(user_id: int, timezone_str: str, lines) -> tuple[int, list[str]]:
+    """
+    Импортирует бэкап (поток строк любого формата). Сначала весь файл разбирается и проверяется
+    во временный файл, потом задачи вставляются одной короткой транзакцией (executemany пачками):
+    пока читается загрузка, блокировка записи БД не держится и outbox/FSM не ждут.
+    Джобы регистрируются одной пачкой после коммита. Возвращает (сколько импортировано, ошибки по записям)
+    """
+    created = [] # (task_id, cron, is_active, policy)
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE, mode="w+", encoding="utf-8") as spool:
+        # Разбор - в потоке: большой файл не останавливает хендлеры остальных чатов
+        errors = await asyncio.to_thread(_spool_rows, lines, timezone_str, spool)
+
+        # Запуски до импорта не догоняем
+        now = utcnow()
+        async with async_session() as session:
+            for rows in _read_spool(spool):
+                for row in rows:
+                    row.update(user_id=user_id, share_link_token=str(uuid.uuid4())[:8], scheduled_since=now)
+                created += await _insert_chunk(session, rows)
+            await session.commit()
+
+    failed = backend.schedule_many([
+        (task_id, cron_exp, timezone_str, policy)
+        for task_id, cron_exp, is_active, policy in created if is_active
+    ])
+    if failed:
+        # Не зарегистрировались - на паузу, чтобы статус в /list не врал
+        async with async_session() as session:
+            await session.execute(update(Task).where(Task.id.in_(list(failed))).values(is_active=False))
+            await session.commit()
+        errors += [f"Задача {task_id} на паузе: {e}" for task_id, e in failed.items()]
+
+    return len(created), errors
@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from config import CHAT_SETTINGS_CACHE_SIZE, CHAT_SETTINGS_TTL
+from database.base import async_session, dialect_insert
+from database.models import User
+
+
+class ChatSettingsCache:
+    """
+    Ограниченный LRU-кэш настроек чата (chat_id -> часовой пояс) с TTL.
+    Промах - один SELECT; если чата еще нет в users, он создается.
+    TTL нужен, если базу меняет кто-то кроме этого процесса; свои изменения сбрасываются через invalidate.
+    """
+
+    def __init__(self, maxsize: int = CHAT_SETTINGS_CACHE_SIZE, ttl: float = CHAT_SETTINGS_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # chat_id -> (timezone, когда истекает)
+        self._items: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    async def get_timezone(self, chat_id: int) -> str:
+        item = self._items.get(chat_id)
+        if item is not None and item[1] > time.monotonic():
+            self._items.move_to_end(chat_id)
+            return item[0]
+
+        tz = await self._load(chat_id)
+        self._items[chat_id] = (tz, time.monotonic() + self.ttl)
+        self._items.move_to_end(chat_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return tz
+
+    def invalidate(self, chat_id: int):
+        self._items.pop(chat_id, None)
+
+    async def _load(self, chat_id: int) -> str:
+        async with async_session() as session:
+            # Обычно запись есть - хватает чтения, без транзакции записи
+            tz = (await session.execute(select(User.timezone).where(User.user_id == chat_id))).scalar_one_or_none()
+            if tz is not None:
+                return tz
+            # Новый чат. Параллельный запрос мог успеть создать его первым - тогда просто читаем
+            await session.execute(dialect_insert(User).values(user_id=chat_id).on_conflict_do_nothing())
+            await session.commit()
+            return (await session.execute(select(User.timezone).where(User.user_id == chat_id))).scalar_one()
+
+    def __len__(self):
+        return len(self._items)
+
+
+chat_settings = ChatSettingsCache()
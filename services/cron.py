@@ -0,0 +1,267 @@
+"""
+Компилятор cron-выражений (5 полей).
+
+Выражение разбирается один раз в битовые маски минут/часов/дней/месяцев/дней недели,
+скомпилированные формы лежат в LRU-кэше по нормализованной строке.
+Следующий запуск ищется сканированием битов, без перебора минут.
+"""
+import calendar
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from apscheduler.triggers.base import BaseTrigger
+
+from config import CRON_CACHE_SIZE
+
+# Карта перевода Linux (0-7) -> English Names
+# Linux: 0=Sun, 1=Mon ... 7=Sun
+DOW_MAP = {
+    '0': 'SUN', '1': 'MON', '2': 'TUE', '3': 'WED',
+    '4': 'THU', '5': 'FRI', '6': 'SAT', '7': 'SUN'
+}
+# Раньше шаг тоже переводился в имя: */2 -> */TUE. SUN мог получиться только из 0 или 7, шаг 0 невалиден
+STEP_REPAIR = {'MON': '1', 'TUE': '2', 'WED': '3', 'THU': '4', 'FRI': '5', 'SAT': '6', 'SUN': '7'}
+DOW_NAMES = {'SUN': 0, 'MON': 1, 'TUE': 2, 'WED': 3, 'THU': 4, 'FRI': 5, 'SAT': 6}
+MONTH_NAMES = {
+    'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6,
+    'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12
+}
+
+# Дальше этого горизонта не ищем (например, для '0 0 30 2 *'). 8 лет покрывают 29 февраля
+MAX_YEARS_AHEAD = 8
+
+
+def normalize_cron(expression: str) -> str:
+    """
+    Заменяет цифры дней недели на имена (MON, TUE...),
+    чтобы избежать путаницы между Linux (0=Sun) и Python (0=Mon).
+    Шаг после '/' - это не день недели, его не трогаем (*/2 остается */2).
+    Испорченный старой версией шаг (*/TUE) возвращаем обратно в число.
+    """
+    parts = expression.strip().split()
+    if len(parts) != 5:
+        return expression # Если формат кривой, вернем как есть, валидатор потом отловит
+
+    items = []
+    for item in parts[4].split(","):
+        value, slash, step = item.partition("/")
+        bounds = [DOW_MAP.get(b, b) for b in value.split("-")]
+        step = STEP_REPAIR.get(step.upper(), step)
+        items.append("-".join(bounds) + slash + step)
+
+    parts[4] = ",".join(items)
+    return " ".join(parts)
+
+
+def _parse_field(field: str, low: int, high: int, names: dict | None = None, step_high: int | None = None) -> int:
+    """
+    Разбирает одно поле в битовую маску (бит N = значение N разрешено).
+    step_high - верхняя граница для '*' и 'N/шаг', если она меньше high
+    (день недели: 7 - то же воскресенье, что и 0, '1/2' не должно его задевать)
+    """
+    step_high = high if step_high is None else step_high
+    mask = 0
+    for item in field.split(","):
+        value, slash, step_str = item.partition("/")
+        if slash:
+            if not step_str.isdigit() or int(step_str) == 0:
+                raise ValueError(f"Неверный шаг: '{item}'")
+            step = int(step_str)
+        else:
+            step = 1
+
+        if value in ("*", "?"):
+            start, end = low, step_high
+        else:
+            start_str, dash, end_str = value.partition("-")
+            start = _parse_value(start_str, low, high, names)
+            if dash:
+                end = _parse_value(end_str, low, high, names)
+                # MON-SUN: воскресенье в конце диапазона = 7
+                if names is DOW_NAMES and end == 0 and start > 0:
+                    end = 7
+            elif slash:
+                end = step_high # '5/15' = с 5 до конца с шагом 15
+            else:
+                end = start
+            if end < start:
+                raise ValueError(f"Неверный диапазон: '{item}'")
+
+        for v in range(start, end + 1, step):
+            mask |= 1 << v
+    return mask
+
+
+def _parse_value(raw: str, low: int, high: int, names: dict | None) -> int:
+    upper = raw.upper()
+    if names and upper in names:
+        return names[upper]
+    if not raw.isdigit():
+        raise ValueError(f"Неверное значение: '{raw}'")
+    value = int(raw)
+    if not (low <= value <= high):
+        raise ValueError(f"Значение {value} вне диапазона {low}-{high}")
+    return value
+
+
+def _next_bit(mask: int, start: int) -> int | None:
+    """Номер первого установленного бита >= start (или None)"""
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+
+class CompiledCron:
+    """Скомпилированное выражение. Неизменяемое, поэтому его можно делить между всеми задачами"""
+    __slots__ = ("expression", "minutes", "hours", "days", "last_day", "months", "dows")
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("Должно быть ровно 5 полей.")
+        minute, hour, day, month, dow = parts
+
+        self.expression = expression
+        self.minutes = _parse_field(minute, 0, 59)
+        self.hours = _parse_field(hour, 0, 23)
+
+        # 'L' в дне месяца = последний день месяца
+        day_items = day.upper().split(",")
+        self.last_day = "L" in day_items
+        day_items = [i for i in day_items if i != "L"]
+        self.days = _parse_field(",".join(day_items), 1, 31) if day_items else 0
+
+        self.months = _parse_field(month, 1, 12, MONTH_NAMES)
+
+        dows = _parse_field(dow, 0, 7, DOW_NAMES, step_high=6)
+        if dows & (1 << 7):
+            dows = (dows | 1) & ~(1 << 7) # 7 = воскресенье = 0
+        self.dows = dows
+
+    def _day_matches(self, year: int, month: int, day: int) -> bool:
+        dom_ok = bool(self.days >> day & 1) or (self.last_day and day == calendar.monthrange(year, month)[1])
+        # datetime.weekday(): 0=Пн, в cron 0=Вс
+        dow_ok = bool(self.dows >> ((calendar.weekday(year, month, day) + 1) % 7) & 1)
+        # Число И день недели, как в APScheduler, на котором работали существующие задачи:
+        # '0 9 13 * FRI' - только пятница 13-е (в классическом cron было бы ИЛИ)
+        return dom_ok and dow_ok
+
+    def next_after(self, dt: datetime) -> datetime | None:
+        """Первый запуск строго после dt. Работает с наивным локальным временем"""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        horizon = t.year + MAX_YEARS_AHEAD
+
+        while t.year <= horizon:
+            if not self.months >> t.month & 1:
+                month = _next_bit(self.months, t.month + 1)
+                if month is None:
+                    t = datetime(t.year + 1, _next_bit(self.months, 1), 1)
+                else:
+                    t = datetime(t.year, month, 1)
+                continue
+
+            if not self._day_matches(t.year, t.month, t.day):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        return None
+
+    def next_fire(self, zone: ZoneInfo, after: datetime) -> datetime | None:
+        """Первый запуск строго после after (aware) по расписанию в поясе zone. Результат в zone"""
+        after_utc = after.astimezone(timezone.utc)
+        local = after.astimezone(zone).replace(tzinfo=None)
+        while True:
+            local = self.next_after(local)
+            if local is None:
+                return None
+            candidate = local.replace(tzinfo=zone)
+            # Несуществующее время (перевод часов вперед) при обратном переводе "съезжает"
+            as_utc = candidate.astimezone(timezone.utc)
+            if as_utc.astimezone(zone).replace(tzinfo=None) != local:
+                continue
+            # Повтор часа при переводе назад: не возвращаем время раньше after
+            if as_utc <= after_utc:
+                continue
+            return candidate
+
+
+def utcnow() -> datetime:
+    """Текущее время в UTC без tzinfo (так храним в БД)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@lru_cache(maxsize=CRON_CACHE_SIZE)
+def _compile(normalized: str) -> CompiledCron:
+    return CompiledCron(normalized)
+
+
+def get_cron(expression: str) -> CompiledCron:
+    """Скомпилированное выражение из кэша. Бросает ValueError, если выражение кривое"""
+    return _compile(" ".join(normalize_cron(expression).split()))
+
+
+@lru_cache(maxsize=64)
+def get_zone(tz: str) -> ZoneInfo:
+    return ZoneInfo(tz)
+
+
+def next_fire(expression: str, tz: str, after: datetime | None = None) -> datetime | None:
+    """Следующий запуск (aware, в поясе tz) после after (по умолчанию - сейчас)"""
+    zone = get_zone(tz)
+    return get_cron(expression).next_fire(zone, after or datetime.now(zone))
+
+
+def validate_cron(expression: str):
+    try:
+        get_cron(expression)
+        return True, ""
+    except ValueError as e:
+        return False, str(e)
+
+
+class CompiledCronTrigger(BaseTrigger):
+    """Триггер APScheduler поверх CompiledCron (вместо CronTrigger.from_crontab)"""
+    __slots__ = ("cron", "timezone")
+
+    def __init__(self, expression: str, timezone: str):
+        self.cron = get_cron(expression)
+        self.timezone = get_zone(timezone)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is None:
+            # Запуск ровно в now тоже подходит
+            return self.cron.next_fire(self.timezone, now - timedelta(microseconds=1))
+        return self.cron.next_fire(self.timezone, previous_fire_time)
+
+    def __getstate__(self):
+        return {"version": 1, "expression": self.cron.expression, "timezone": self.timezone.key}
+
+    def __setstate__(self, state):
+        self.cron = get_cron(state["expression"])
+        self.timezone = get_zone(state["timezone"])
+
+    def __str__(self):
+        return f"cron[{self.cron.expression}]"
+
+    def __repr__(self):
+        return f"<CompiledCronTrigger ({self.cron.expression!r}, timezone='{self.timezone.key}')>"
+
+
+@lru_cache(maxsize=CRON_CACHE_SIZE)
+def get_trigger(expression: str, tz: str) -> CompiledCronTrigger:
+    """Триггер из кэша: одинаковые (cron, пояс) делят один объект"""
+    return CompiledCronTrigger(expression, tz)
@@ -1,87 +1,20 @@
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 from sqlalchemy import select, update, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import Task, User, SharedLink
-from database.base import async_session
-from croniter import croniter
-from datetime import datetime
+from database.base import async_session, on_commit
+from services.scheduling import (
+    backend, next_run_utc, dispatch_many, replay_outbox, fire_times, apply_misfire_policy, MISFIRE_POLICIES,
+    SET_NEXT_RUN_STMT
+)
+from services.task_cache import task_cache
+from services.cron import normalize_cron, validate_cron, utcnow
+from config import RESTORE_CHUNK
+import asyncio
+import time
 import uuid
 
-scheduler = AsyncIOScheduler()
-
-# Карта перевода Linux (0-7) -> English Names
-# Linux: 0=Sun, 1=Mon ... 7=Sun
-DOW_MAP = {
-    '0': 'SUN', '1': 'MON', '2': 'TUE', '3': 'WED',
-    '4': 'THU', '5': 'FRI', '6': 'SAT', '7': 'SUN'
-}
-
-def normalize_cron(expression: str) -> str:
-    """
-    Заменяет цифры дней недели на имена (MON, TUE...), 
-    чтобы избежать путаницы между Linux (0=Sun) и Python (0=Mon).
-    """
-    parts = expression.strip().split()
-    if len(parts) != 5:
-        return expression # Если формат кривой, вернем как есть, валидатор потом отловит
-    
-    dow_part = parts[4]
-    new_dow = ""
-    
-    # Проходим по символам 5-й части
-    # Т.к. дни недели это только цифры 0-7, знаки -,/,* и запятая,
-    # мы можем просто заменять цифры на буквы.
-    for char in dow_part:
-        if char in DOW_MAP:
-            new_dow += DOW_MAP[char]
-        else:
-            new_dow += char
-            
-    parts[4] = new_dow
-    return " ".join(parts)
-
-async def send_message_job(bot, chat_id: int, text: str, content_type: str = "text", file_id: str = None):
-    try:
-        if content_type == "text":
-            await bot.send_message(chat_id=chat_id, text=text)
-            return
-
-        if content_type == "photo":
-            await bot.send_photo(chat_id=chat_id, photo=file_id, caption=text)
-        elif content_type == "video":
-            await bot.send_video(chat_id=chat_id, video=file_id, caption=text)
-        elif content_type == "audio":
-            await bot.send_audio(chat_id=chat_id, audio=file_id, caption=text)
-        elif content_type == "document":
-            await bot.send_document(chat_id=chat_id, document=file_id, caption=text)
-        
-        elif content_type == "voice":
-            await bot.send_voice(chat_id=chat_id, voice=file_id)
-            if text: await bot.send_message(chat_id=chat_id, text=text)
-        elif content_type == "video_note":
-            await bot.send_video_note(chat_id=chat_id, video_note=file_id)
-            if text: await bot.send_message(chat_id=chat_id, text=text)
-        elif content_type == "sticker":
-            await bot.send_sticker(chat_id=chat_id, sticker=file_id)
-            if text: await bot.send_message(chat_id=chat_id, text=text)
-        else:
-            await bot.send_message(chat_id=chat_id, text=f"[{content_type}] {text}")
-
-    except Exception as e:
-        print(f"[ERROR] {chat_id}: {e}")
-
-def validate_cron(expression: str):
-    # Сначала нормализуем (превращаем 1 в MON), потом проверяем
-    norm_exp = normalize_cron(expression)
-    parts = norm_exp.strip().split()
-    
-    if len(parts) != 5: return False, "Должно быть ровно 5 полей."
-    try:
-        croniter(norm_exp, datetime.now())
-        return True, ""
-    except Exception as e:
-        return False, str(e)
+# Операции над задачами (add/edit/pause/...) работают в сессии вызывающего и не коммитят:
+# flush + on_commit. Планировщик и кэши меняются только после commit(session) вызывающего
 
 async def add_task(bot, session: AsyncSession, user_id: int, cron_exp: str, text: str, timezone_str: str, 
                    content_type: str = "text", file_id: str = None):
@@ -97,49 +30,40 @@ async def add_task(bot, session: AsyncSession, user_id: int, cron_exp: str, text
         content_type=content_type,
         file_id=file_id,
         share_link_token=token,
-        is_active=True
+        is_active=True,
+        next_run_at=next_run_utc(final_cron, timezone_str),
+        scheduled_since=utcnow()
     )
     session.add(new_task)
-    await session.commit()
-    await session.refresh(new_task) 
+    # flush выдает id без коммита и без повторного SELECT
+    await session.flush()
 
-    scheduler.add_job(
-        send_message_job,
-        trigger=CronTrigger.from_crontab(final_cron, timezone=timezone_str),
-        id=str(new_task.id),
-        kwargs={
-            "bot": bot, "chat_id": user_id, 
-            "text": text, "content_type": content_type, "file_id": file_id
-        },
-        replace_existing=True
-    )
-    return new_task.id
+    task_id = new_task.id
+    on_commit(session, lambda: backend.schedule(task_id, final_cron, timezone_str))
+    return task_id
 
 async def edit_task(bot, session: AsyncSession, task_id: int, user_id: int, cron_exp: str, text: str, timezone_str: str):
     
     # НОРМАЛИЗАЦИЯ
     final_cron = normalize_cron(cron_exp)
     
-    stmt = update(Task).where(Task.id == task_id, Task.user_id == user_id).values(
-        cron_expression=final_cron,
-        message_text=text
-    )
-    await session.execute(stmt)
-    await session.commit()
-    
-    res = await session.execute(select(Task).where(Task.id == task_id))
+    res = await session.execute(select(Task).where(Task.id == task_id, Task.user_id == user_id))
     task = res.scalar_one()
+    cron_changed = task.cron_expression != final_cron
 
-    scheduler.add_job(
-        send_message_job,
-        trigger=CronTrigger.from_crontab(final_cron, timezone=timezone_str),
-        id=str(task_id),
-        kwargs={
-            "bot": bot, "chat_id": user_id, 
-            "text": text, "content_type": task.content_type, "file_id": task.file_id
-        },
-        replace_existing=True
-    )
+    task.message_text = text
+    if cron_changed:
+        task.cron_expression = final_cron
+        task.next_run_at = next_run_utc(final_cron, timezone_str)
+        # Запуски старого расписания (и нового - до правки) не догоняем
+        task.scheduled_since = utcnow()
+    await session.flush()
+
+    # Текст джоба возьмет из кэша при срабатывании - перерегистрировать не нужно
+    on_commit(session, lambda: task_cache.invalidate(task_id))
+    if cron_changed and task.is_active:
+        policy = task.misfire_policy
+        on_commit(session, lambda: backend.schedule(task_id, final_cron, timezone_str, policy))
 
 async def delete_task(session: AsyncSession, task_id: int, user_id: int) -> bool:
     query = select(Task).where(Task.id == task_id, Task.user_id == user_id)
@@ -147,17 +71,16 @@ async def delete_task(session: AsyncSession, task_id: int, user_id: int) -> bool
     task = result.scalar_one_or_none()
     if not task: return False
     await session.delete(task)
-    await session.commit()
-    try: scheduler.remove_job(str(task_id))
-    except: pass
+    await session.flush()
+    on_commit(session, lambda: backend.unschedule(task_id))
+    on_commit(session, lambda: task_cache.invalidate(task_id))
     return True
 
 async def pause_task(session: AsyncSession, task_id: int, user_id: int) -> bool:
     stmt = update(Task).where(Task.id == task_id, Task.user_id == user_id).values(is_active=False)
     result = await session.execute(stmt)
-    await session.commit()
-    try: scheduler.remove_job(str(task_id))
-    except: pass 
+    if result.rowcount > 0:
+        on_commit(session, lambda: backend.unschedule(task_id))
     return result.rowcount > 0
 
 async def resume_task(bot, session: AsyncSession, task_id: int, user_id: int, timezone_str: str) -> bool:
@@ -166,89 +89,188 @@ async def resume_task(bot, session: AsyncSession, task_id: int, user_id: int, ti
     task = result.scalar_one_or_none()
     if not task: return False
     task.is_active = True
-    await session.commit()
-    scheduler.add_job(
-        send_message_job,
-        trigger=CronTrigger.from_crontab(task.cron_expression, timezone=timezone_str),
-        id=str(task.id),
-        kwargs={
-            "bot": bot, "chat_id": user_id, 
-            "text": task.message_text, 
-            "content_type": task.content_type, 
-            "file_id": task.file_id
-        },
-        replace_existing=True
-    )
+    task.next_run_at = next_run_utc(task.cron_expression, timezone_str)
+    # Запуски, выпавшие на паузу, не догоняем
+    task.scheduled_since = utcnow()
+    await session.flush()
+    cron_exp, policy = task.cron_expression, task.misfire_policy
+    on_commit(session, lambda: backend.schedule(task_id, cron_exp, timezone_str, policy))
+    return True
+
+async def set_misfire_policy(session: AsyncSession, task_id: int, user_id: int, policy: str) -> bool:
+    if policy not in MISFIRE_POLICIES:
+        raise ValueError(f"Неизвестная политика: {policy}")
+    query = select(Task).where(Task.id == task_id, Task.user_id == user_id)
+    task = (await session.execute(query)).scalar_one_or_none()
+    if not task: return False
+    task.misfire_policy = policy
+    await session.flush()
+    if task.is_active:
+        on_commit(session, lambda: backend.set_policy(task_id, policy))
     return True
 
 async def pause_all_tasks(session: AsyncSession, user_id: int):
-    result = await session.execute(select(Task.id).where(Task.user_id == user_id))
+    result = await session.execute(select(Task.id).where(Task.user_id == user_id, Task.is_active == True))
     task_ids = result.scalars().all()
-    stmt = update(Task).where(Task.user_id == user_id).values(is_active=False)
+    stmt = update(Task).where(Task.user_id == user_id, Task.is_active == True).values(is_active=False)
     await session.execute(stmt)
-    await session.commit()
-    for t_id in task_ids:
-        try: scheduler.remove_job(str(t_id))
-        except: pass
+    on_commit(session, lambda: backend.unschedule_many(task_ids))
 
-async def resume_all_tasks(bot, session: AsyncSession, user_id: int, timezone_str: str):
-    result = await session.execute(select(Task).where(Task.user_id == user_id))
+async def resume_all_tasks(bot, session: AsyncSession, user_id: int, timezone_str: str) -> dict[int, Exception]:
+    """
+    Запускает задачи чата, которые стоят на паузе (активные не трогает).
+    Возвращает ошибки по id задачи: такие задачи остаются на паузе.
+    Ошибки регистрации джоб выясняются только после коммита - они дописываются в тот же словарь
+    """
+    result = await session.execute(select(Task).where(Task.user_id == user_id, Task.is_active == False))
     tasks = result.scalars().all()
-    stmt = update(Task).where(Task.user_id == user_id).values(is_active=True)
-    await session.execute(stmt)
-    await session.commit()
+    errors = {}
+    resumed = []
+    now = utcnow()
     for task in tasks:
         try:
-            scheduler.add_job(
-                send_message_job,
-                trigger=CronTrigger.from_crontab(task.cron_expression, timezone=timezone_str),
-                id=str(task.id),
-                kwargs={
-                    "bot": bot, "chat_id": user_id, 
-                    "text": task.message_text,
-                    "content_type": task.content_type, 
-                    "file_id": task.file_id
-                },
-                replace_existing=True
-            )
+            task.next_run_at = next_run_utc(task.cron_expression, timezone_str)
         except Exception as e:
-            print(f"Error resuming task {task.id}: {e}")
+            errors[task.id] = e
+            continue
+        task.is_active = True
+        task.scheduled_since = now
+        resumed.append((task.id, task.cron_expression, timezone_str, task.misfire_policy))
+    await session.flush()
+    for task_id, e in errors.items():
+        print(f"⚠️ Не удалось запустить задачу {task_id}: {e}")
+
+    async def schedule():
+        failed = backend.schedule_many(resumed)
+        if not failed: return
+        # Не зарегистрировались - возвращаем на паузу, чтобы статус в /list не врал
+        async with async_session() as fix_session:
+            await fix_session.execute(update(Task).where(Task.id.in_(list(failed))).values(is_active=False))
+            await fix_session.commit()
+        errors.update(failed)
+        for task_id, e in failed.items():
+            print(f"⚠️ Не удалось запустить задачу {task_id}: {e}")
+
+    on_commit(session, schedule)
+    return errors
 
 async def delete_all_tasks(session: AsyncSession, user_id: int):
     result = await session.execute(select(Task.id).where(Task.user_id == user_id))
     task_ids = result.scalars().all()
     stmt = delete(Task).where(Task.user_id == user_id)
     await session.execute(stmt)
-    await session.commit()
-    for t_id in task_ids:
-        try: scheduler.remove_job(str(t_id))
-        except: pass
+    on_commit(session, lambda: backend.unschedule_many(task_ids))
+    on_commit(session, lambda: task_cache.invalidate_many(task_ids))
+
+async def reschedule_chat(chat_id: int, timezone_str: str) -> int:
+    """
+    Переводит все активные задачи чата на новый часовой пояс за один проход:
+    next_run_at - одним executemany, джобы - одной пачкой (планировщик просыпается один раз в конце).
+    Триггеры для повторяющихся выражений берутся из кэша, а не собираются заново
+    """
+    async with async_session() as session:
+        query = select(Task.id, Task.cron_expression, Task.misfire_policy).where(
+            Task.user_id == chat_id, Task.is_active == True
+        )
+        rows = (await session.execute(query)).all()
+        if not rows: return 0
+        params = []
+        for task_id, cron, _ in rows:
+            try:
+                next_at = next_run_utc(cron, timezone_str)
+            except Exception:
+                next_at = None # Ошибку покажет регистрация ниже
+            params.append({"t_id": task_id, "t_next": next_at})
+        await session.execute(SET_NEXT_RUN_STMT, params)
+        # Запуски по старому поясу не догоняем
+        await session.execute(
+            update(Task).where(Task.user_id == chat_id, Task.is_active == True).values(scheduled_since=utcnow())
+        )
+        await session.commit()
+
+    errors = backend.schedule_many([(task_id, cron, timezone_str, policy) for task_id, cron, policy in rows])
+    for task_id, e in errors.items():
+        print(f"⚠️ Ошибка переноса задачи {task_id} в пояс {timezone_str}: {e}")
+    return len(rows)
+
+async def deactivate_chats(chat_ids) -> int:
+    """
+    Ставит на паузу все задачи чатов, куда бот больше не может писать
+    (заблокировали, удалили из группы, чат не найден). Один UPDATE на всю пачку чатов.
+    """
+    chat_ids = list(chat_ids)
+    async with async_session() as session:
+        query = select(Task.id).where(Task.user_id.in_(chat_ids), Task.is_active == True)
+        task_ids = (await session.execute(query)).scalars().all()
+        if not task_ids: return 0
+        stmt = update(Task).where(Task.user_id.in_(chat_ids), Task.is_active == True).values(is_active=False)
+        await session.execute(stmt)
+        await session.commit()
+    backend.unschedule_many(task_ids)
+    print(f"🚫 Чаты недоступны {chat_ids}: на паузу поставлено задач: {len(task_ids)}")
+    return len(task_ids)
 
 async def restore_tasks(bot):
+    """
+    Восстанавливает джобы активных задач. Запускается фоном (бот уже принимает апдейты),
+    читает БД пачками по id и не держит всю таблицу в памяти.
+    Запуски, пропущенные с tasks.scheduled_since (последнее срабатывание, запуск после паузы, правка) -
+    пока бот лежал или шло восстановление, - отправляются сразу по политике задачи. Перед этим досылаются срабатывания из outbox,
+    записанные, но не отправленные до падения.
+    """
+    await replay_outbox()
+    if not backend.in_memory:
+        # DB-планировщик читает расписание прямо из tasks.next_run_at
+        return
     print("🔄 Восстановление задач...")
-    async with async_session() as session:
-        query = select(Task, User).join(User, Task.user_id == User.user_id).where(Task.is_active == True)
-        result = await session.execute(query)
-        count = 0
-        for task, user in result:
+    started = utcnow()
+    clock = time.monotonic()
+    last_id = 0
+    count = caught_up = 0
+
+    while True:
+        async with async_session() as session:
+            query = (
+                select(Task.id, Task.cron_expression, Task.misfire_policy, User.timezone, Task.scheduled_since)
+                .join(User, Task.user_id == User.user_id)
+                .where(Task.is_active == True, Task.id > last_id)
+                .order_by(Task.id)
+                .limit(RESTORE_CHUNK)
+            )
+            rows = (await session.execute(query)).all()
+            if not rows: break
+
+        errors = backend.schedule_many([(task_id, cron, tz, policy) for task_id, cron, policy, tz, _ in rows])
+        for task_id, e in errors.items():
+            print(f"⚠️ Ошибка восстановления задачи {task_id}: {e}")
+        count += len(rows) - len(errors)
+
+        now = utcnow()
+        missed = []
+        for task_id, cron, policy, tz, since in rows:
+            if task_id in errors: continue
             try:
-                scheduler.add_job(
-                    send_message_job,
-                    trigger=CronTrigger.from_crontab(task.cron_expression, timezone=user.timezone),
-                    id=str(task.id),
-                    kwargs={
-                        "bot": bot, "chat_id": task.user_id, 
-                        "text": task.message_text,
-                        "content_type": task.content_type, 
-                        "file_id": task.file_id
-                    },
-                    replace_existing=True
-                )
-                count += 1
+                if policy == "skip" or since is None:
+                    # Простой не догоняем (или не знаем, когда был последний запуск) -
+                    # только запуски за время восстановления: джоба их уже не увидит
+                    times = fire_times(cron, tz, started, now)
+                else:
+                    times = apply_misfire_policy(fire_times(cron, tz, since, now), policy, now)
+                missed.extend((task_id, at) for at in times)
             except Exception as e:
-                print(f"⚠️ Ошибка восстановления задачи {task.id}: {e}")
-        print(f"✅ Восстановлено: {count}")
-        
+                print(f"⚠️ Ошибка восстановления задачи {task_id}: {e}")
+
+        # Одной пачкой через outbox: если джоба успела сработать сама, второй раз не отправим
+        await dispatch_many(missed)
+        caught_up += len(missed)
+
+        last_id = rows[-1][0]
+        print(f"⏳ Восстановлено: {count}...")
+        # Отдаем управление, чтобы хендлеры не ждали конца восстановления
+        await asyncio.sleep(0)
+
+    print(f"✅ Восстановлено: {count} за {time.monotonic() - clock:.1f} сек (догнали пропущенных: {caught_up})")
+
 # --- ЛОГИКА СНЕПШОТОВ (SHARING) ---
 
 async def create_share_snapshot(session: AsyncSession, task_id: int):
@@ -270,7 +292,7 @@ async def create_share_snapshot(session: AsyncSession, task_id: int):
         file_id=task.file_id
     )
     session.add(snapshot)
-    await session.commit()
+    await session.flush()
     
     return token
 
@@ -0,0 +1,58 @@
+from sqlalchemy import select, delete, func, insert
+
+from database.base import async_session
+from database.models import FailedDelivery
+from services.delivery import delivery, SendIntent
+
+# Сколько записей читать за раз при повторе
+REPLAY_CHUNK = 500
+
+
+async def save_failed(rows: list[dict], replayed: list[int] = ()):
+    """Пишет пачку неудачных отправок одним запросом и удаляет обработанные повторы replayed"""
+    async with async_session() as session:
+        if replayed:
+            await session.execute(delete(FailedDelivery).where(FailedDelivery.id.in_(replayed)))
+        if rows:
+            await session.execute(insert(FailedDelivery), rows)
+        await session.commit()
+
+
+async def failed_summary() -> list[tuple[str, int]]:
+    """[(класс ошибки, количество), ...] по убыванию"""
+    async with async_session() as session:
+        query = (
+            select(FailedDelivery.error_class, func.count())
+            .group_by(FailedDelivery.error_class)
+            .order_by(func.count().desc())
+        )
+        return [(error, count) for error, count in await session.execute(query)]
+
+
+async def replay_failed() -> int:
+    """
+    Возвращает все неудачные отправки в очередь доставки. Из таблицы запись удаляет очередь,
+    когда отправка обработана: очередь в памяти, и при рестарте до отправки запись не теряется.
+    Записи, которые уже повторяются, второй раз не ставятся
+    """
+    total = 0
+    last_id = 0
+    async with async_session() as session:
+        while True:
+            query = (
+                select(FailedDelivery)
+                .where(FailedDelivery.id > last_id)
+                .order_by(FailedDelivery.id)
+                .limit(REPLAY_CHUNK)
+            )
+            rows = (await session.execute(query)).scalars().all()
+            if not rows: break
+
+            last_id = rows[-1].id
+            for row in rows:
+                if row.id in delivery.replaying: continue
+                delivery.replaying.add(row.id)
+                delivery.submit(SendIntent(row.chat_id, row.message_text, row.content_type, row.file_id,
+                                           task_id=row.task_id, failed_id=row.id))
+                total += 1
+    return total
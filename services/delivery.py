@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError, TelegramBadRequest
+)
+
+from services.outbox import outbox
+from config import (
+    DELIVERY_WORKERS, DELIVERY_GLOBAL_RATE, DELIVERY_PRIVATE_RATE,
+    DELIVERY_GROUP_RATE, DELIVERY_STATS_INTERVAL,
+    DELIVERY_MAX_ATTEMPTS, DELIVERY_RETRY_BASE_DELAY, DELIVERY_RETRY_MAX_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+# Окно, за которое считаем скорость отправки (сек)
+RATE_WINDOW = 60
+# Как часто сбрасывать накопленные неудачные отправки в failed_deliveries (сек)
+DEAD_LETTER_FLUSH_DELAY = 1
+
+# Сколько помним недоступный чат, чтобы выкидывать его отправки, уже стоящие в очереди (сек)
+GONE_CHAT_TTL = 600
+
+# Ошибки, после которых есть смысл повторить (флуд-лимит, сеть, 5xx)
+TRANSIENT_ERRORS = (TelegramRetryAfter, TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)
+
+
+def is_chat_gone(error: Exception) -> bool:
+    """Бот заблокирован / удален из группы / чата больше нет - писать туда бесполезно"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+
+class SendIntent:
+    """Намерение отправить сообщение: кладется в очередь, отправляется воркером"""
+    __slots__ = ("chat_id", "text", "content_type", "file_id", "task_id", "attempt", "outbox_id", "failed_id")
+
+    def __init__(self, chat_id: int, text: str | None, content_type: str = "text", file_id: str | None = None,
+                 task_id: int | None = None, attempt: int = 0, outbox_id: int | None = None,
+                 failed_id: int | None = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.content_type = content_type
+        self.file_id = file_id
+        self.task_id = task_id
+        self.attempt = attempt
+        self.outbox_id = outbox_id
+        # Повтор из failed_deliveries: запись удаляется, только когда отправка обработана
+        self.failed_id = failed_id
+
+    def retry(self) -> "SendIntent":
+        """Копия для следующей попытки (исходный объект может лежать в кэше задач)"""
+        return SendIntent(self.chat_id, self.text, self.content_type, self.file_id,
+                          self.task_id, self.attempt + 1, self.outbox_id, self.failed_id)
+
+    def for_outbox(self, outbox_id: int) -> "SendIntent":
+        """Копия, привязанная к записи outbox (ее отметят после отправки)"""
+        return SendIntent(self.chat_id, self.text, self.content_type, self.file_id,
+                          self.task_id, self.attempt, outbox_id, self.failed_id)
+
+    @property
+    def cost(self) -> int:
+        """Сколько вызовов API займет отправка (голос/кружок/стикер + отдельный текст)"""
+        if self.content_type in ("voice", "video_note", "sticker") and self.text:
+            return 2
+        return 1
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, cost: int = 1) -> float:
+        """
+        Берет токены, если есть хотя бы один (баланс может уйти в минус на cost-1).
+        Возвращает 0 при успехе или сколько секунд подождать.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= cost
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self, cost: int = 1) -> float:
+        """Бронирует токены всегда. Возвращает, сколько ждать до их появления"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= cost
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class DeliveryQueue:
+    """
+    Очередь отправки между планировщиком и Bot API.
+    Джобы кладут SendIntent, пул воркеров отправляет их под общим лимитом
+    бота и отдельными лимитами на каждый чат.
+    """
+
+    def __init__(self, workers: int = DELIVERY_WORKERS):
+        self.workers = workers
+        self.bot = None
+        self.queue: asyncio.Queue[SendIntent] = asyncio.Queue()
+        self.global_bucket = TokenBucket(DELIVERY_GLOBAL_RATE, DELIVERY_GLOBAL_RATE)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._deferred = 0
+        self._in_flight = 0
+        self._sent_times: deque[float] = deque()
+        self.sent_total = 0
+        self.failed_total = 0
+        self.retried_total = 0
+        self._dead: list[dict] = []
+        # Повторенные записи failed_deliveries: обработанные (к удалению) и еще не обработанные
+        self._replayed: list[int] = []
+        self.replaying: set[int] = set()
+        self._dead_flush: asyncio.Task | None = None
+        # chat_id -> когда узнали, что чат недоступен
+        self.gone_chats: dict[int, float] = {}
+        self._gone_pending: set[int] = set()
+        self._gone_flush: asyncio.Task | None = None
+        self.dropped_total = 0
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+
+    def start(self, bot):
+        self.bot = bot
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"delivery-{i}"))
+        self._tasks.append(asyncio.create_task(self._stats_loop(), name="delivery-stats"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._dead_flush:
+            await self._dead_flush
+        if self._gone_flush:
+            await self._gone_flush
+
+    # --- ПРИЕМ ---
+
+    def submit(self, intent: SendIntent):
+        self.queue.put_nowait(intent)
+
+    def _defer(self, intent: SendIntent, delay: float):
+        """Возвращает интент в очередь позже, не занимая воркер ожиданием"""
+        self._deferred += 1
+
+        def _requeue():
+            self._deferred -= 1
+            self.queue.put_nowait(intent)
+
+        asyncio.get_running_loop().call_later(delay, _requeue)
+
+    # --- ЛИМИТЫ ---
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный ID = группа/канал
+            rate = DELIVERY_GROUP_RATE if chat_id < 0 else DELIVERY_PRIVATE_RATE
+            bucket = TokenBucket(rate, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        """Выкидываем полные (простаивающие) бакеты, чтобы словарь не рос бесконечно"""
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_full()]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+
+    # --- ВОРКЕР ---
+
+    async def _worker(self):
+        while True:
+            intent = await self.queue.get()
+            try:
+                if intent.chat_id in self.gone_chats:
+                    self.dropped_total += 1
+                    self._done(intent)
+                    continue
+
+                wait = self._chat_bucket(intent.chat_id).try_consume(intent.cost)
+                if wait > 0:
+                    self._defer(intent, wait)
+                    continue
+
+                wait = self.global_bucket.reserve(intent.cost)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                self._in_flight += 1
+                try:
+                    await send_intent(self.bot, intent)
+                    self.sent_total += 1
+                    self._sent_times.append(time.monotonic())
+                    self._done(intent)
+                except Exception as e:
+                    self._on_error(intent, e)
+                finally:
+                    self._in_flight -= 1
+            finally:
+                self.queue.task_done()
+
+    def _done(self, intent: SendIntent):
+        """Срабатывание обработано окончательно - после рестарта его не повторять"""
+        if intent.outbox_id is not None:
+            outbox.mark_sent(intent.outbox_id)
+        if intent.failed_id is not None:
+            self._replayed.append(intent.failed_id)
+            if self._dead_flush is None:
+                self._dead_flush = asyncio.create_task(self._flush_dead())
+
+    # --- ОШИБКИ ---
+
+    def _on_error(self, intent: SendIntent, error: Exception):
+        if is_chat_gone(error):
+            self.dropped_total += 1
+            self.mark_chat_gone(intent.chat_id)
+            self._done(intent)
+            return
+
+        if isinstance(error, TRANSIENT_ERRORS) and intent.attempt + 1 < DELIVERY_MAX_ATTEMPTS:
+            self.retried_total += 1
+            # Повтор откладываем таймером: остальные отправки этой минуты не ждут
+            self._defer(intent.retry(), retry_delay(intent.attempt, error))
+            return
+
+        self.failed_total += 1
+        self._done(intent)
+        logger.warning("Не удалось отправить в %s (попыток: %s): %s: %s",
+                       intent.chat_id, intent.attempt + 1, type(error).__name__, error)
+        self._dead.append({
+            "task_id": intent.task_id, "chat_id": intent.chat_id,
+            "message_text": intent.text, "content_type": intent.content_type, "file_id": intent.file_id,
+            "error_class": type(error).__name__, "error_text": str(error)[:500],
+            "attempts": intent.attempt + 1,
+            "failed_at": datetime.now(timezone.utc).replace(tzinfo=None),
+        })
+        if self._dead_flush is None:
+            self._dead_flush = asyncio.create_task(self._flush_dead())
+
+    def mark_chat_gone(self, chat_id: int):
+        """Чат недоступен: выкидываем его отправки и (пачкой) ставим его задачи на паузу"""
+        if chat_id in self.gone_chats: return
+        logger.info("Чат %s недоступен, его задачи будут поставлены на паузу", chat_id)
+        self.gone_chats[chat_id] = time.monotonic()
+        self._gone_pending.add(chat_id)
+        if self._gone_flush is None:
+            self._gone_flush = asyncio.create_task(self._flush_gone())
+
+    def mark_chat_back(self, chat_id: int):
+        """Бота снова пустили в чат - отправки туда больше не выкидываем"""
+        self.gone_chats.pop(chat_id, None)
+
+    async def _flush_gone(self):
+        """Копит недоступные чаты секунду и выключает их задачи одним UPDATE"""
+        from services.cron_manager import deactivate_chats
+        try:
+            await asyncio.sleep(DEAD_LETTER_FLUSH_DELAY)
+        except asyncio.CancelledError:
+            pass
+        chat_ids, self._gone_pending = self._gone_pending, set()
+        self._gone_flush = None
+        try:
+            await deactivate_chats(chat_ids)
+        except Exception as e:
+            logger.error("Не удалось выключить задачи чатов %s: %s", chat_ids, e)
+
+    def _prune_gone(self):
+        border = time.monotonic() - GONE_CHAT_TTL
+        for chat_id in [c for c, at in self.gone_chats.items() if at < border]:
+            del self.gone_chats[chat_id]
+
+    async def _flush_dead(self):
+        """
+        Копит неудачи секунду и пишет их в failed_deliveries одной пачкой.
+        В той же транзакции удаляет обработанные повторы: повтор, снова не доставленный, не задвоится
+        """
+        from services.dead_letters import save_failed
+        try:
+            await asyncio.sleep(DEAD_LETTER_FLUSH_DELAY)
+        except asyncio.CancelledError:
+            pass
+        rows, self._dead = self._dead, []
+        replayed, self._replayed = self._replayed, []
+        self._dead_flush = None
+        try:
+            await save_failed(rows, replayed)
+        except Exception as e:
+            # Повторы остаются в таблице, их можно повторить еще раз
+            logger.error("Не удалось сохранить %s неудачных отправок: %s", len(rows), e)
+        finally:
+            self.replaying.difference_update(replayed)
+
+    # --- МЕТРИКИ ---
+
+    def drain_rate(self) -> float:
+        """Отправок в секунду за последние RATE_WINDOW секунд"""
+        border = time.monotonic() - RATE_WINDOW
+        while self._sent_times and self._sent_times[0] < border:
+            self._sent_times.popleft()
+        return len(self._sent_times) / RATE_WINDOW
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "deferred": self._deferred,
+            "in_flight": self._in_flight,
+            "rate": round(self.drain_rate(), 2),
+            "sent": self.sent_total,
+            "retried": self.retried_total,
+            "failed": self.failed_total,
+            "dropped": self.dropped_total,
+            "chats": len(self.chat_buckets),
+        }
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(DELIVERY_STATS_INTERVAL)
+            self._prune_buckets()
+            self._prune_gone()
+            stats = self.stats()
+            if stats["queued"] or stats["deferred"] or stats["rate"]:
+                logger.info("📬 Доставка: %s", stats)
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Сколько ждать перед повтором: retry_after от Telegram или экспоненциально с джиттером"""
+    if isinstance(error, TelegramRetryAfter):
+        return error.retry_after + random.uniform(0, 1)
+    return random.uniform(0, min(DELIVERY_RETRY_MAX_DELAY, DELIVERY_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def send_intent(bot, intent: SendIntent):
+    chat_id, text, content_type, file_id = intent.chat_id, intent.text, intent.content_type, intent.file_id
+
+    if content_type == "text":
+        await bot.send_message(chat_id=chat_id, text=text)
+        return
+
+    if content_type == "photo":
+        await bot.send_photo(chat_id=chat_id, photo=file_id, caption=text)
+    elif content_type == "video":
+        await bot.send_video(chat_id=chat_id, video=file_id, caption=text)
+    elif content_type == "audio":
+        await bot.send_audio(chat_id=chat_id, audio=file_id, caption=text)
+    elif content_type == "document":
+        await bot.send_document(chat_id=chat_id, document=file_id, caption=text)
+
+    elif content_type == "voice":
+        await bot.send_voice(chat_id=chat_id, voice=file_id)
+        if text: await bot.send_message(chat_id=chat_id, text=text)
+    elif content_type == "video_note":
+        await bot.send_video_note(chat_id=chat_id, video_note=file_id)
+        if text: await bot.send_message(chat_id=chat_id, text=text)
+    elif content_type == "sticker":
+        await bot.send_sticker(chat_id=chat_id, sticker=file_id)
+        if text: await bot.send_message(chat_id=chat_id, text=text)
+    else:
+        await bot.send_message(chat_id=chat_id, text=f"[{content_type}] {text}")
+
+
+# Один экземпляр на процесс (как scheduler в cron_manager)
+delivery = DeliveryQueue()
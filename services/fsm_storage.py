@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from sqlalchemy import select, update, delete
+
+from config import FSM_TTL, FSM_CACHE_SIZE, FSM_CACHE_TTL, FSM_SWEEP_INTERVAL
+from database.base import async_session, dialect_insert
+from database.models import FsmRecord
+from services.cron import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Ключей в одном UPDATE (SQLite ограничивает число параметров)
+TOUCH_CHUNK = 500
+
+
+class _Entry:
+    __slots__ = ("state", "data", "stored", "used_at", "touched", "lock")
+
+    def __init__(self, state: str | None = None, data: dict | None = None, stored: bool = False):
+        self.state = state
+        self.data = data or {}
+        # Есть ли строка в БД
+        self.stored = stored
+        self.used_at = time.monotonic()
+        # Читали после последней чистки - продлить жизнь строки в БД
+        self.touched = False
+        # Записи одного ключа идут по очереди, иначе старая может закоммититься последней
+        self.lock = asyncio.Lock()
+
+
+class DbStorage(BaseStorage):
+    """
+    Хранилище FSM в БД с write-through кэшем в памяти.
+    Чтения идут из кэша (промах - один SELECT), каждое изменение сразу пишется в БД.
+    Периодическая чистка выгружает из памяти простаивающие ключи
+    и удаляет из БД состояния, которыми не пользовались дольше FSM_TTL.
+    """
+
+    def __init__(self, maxsize: int = FSM_CACHE_SIZE, idle: float = FSM_CACHE_TTL, ttl: int = FSM_TTL):
+        self.maxsize = maxsize
+        self.idle = idle
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._items: OrderedDict[str, _Entry] = OrderedDict()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._sweep_loop(), name="fsm-sweep")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._flush_touched()
+
+    # --- API aiogram ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        new_state = state.state if isinstance(state, State) else state
+        if new_state == entry.state:
+            entry.touched = True
+            return
+        entry.state = new_state
+        await self._write(key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        entry = await self._entry(key)
+        entry.touched = True
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._entry(key)
+        new_data = dict(data)
+        if new_data == entry.data:
+            entry.touched = True
+            return
+        entry.data = new_data
+        await self._write(key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        entry = await self._entry(key)
+        entry.touched = True
+        return entry.data.copy()
+
+    # --- КЭШ И БД ---
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        db_key = self.key_builder.build(key)
+        entry = self._items.get(db_key)
+        if entry is None:
+            loaded = await self._load(db_key)
+            # Пока шел SELECT, ключ мог загрузить параллельный запрос - берем его запись
+            entry = self._items.get(db_key) or loaded
+            self._items[db_key] = entry
+        self._items.move_to_end(db_key)
+        entry.used_at = time.monotonic()
+        # maxsize=0 - без кэша: каждое чтение идет в БД
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return entry
+
+    async def _load(self, db_key: str) -> _Entry:
+        async with async_session() as session:
+            row = (await session.execute(select(FsmRecord).where(FsmRecord.key == db_key))).scalar_one_or_none()
+        # Просроченную строку, до которой еще не дошла чистка, считаем пустой
+        if row is None or row.updated_at < utcnow() - timedelta(seconds=self.ttl):
+            return _Entry(stored=row is not None)
+        return _Entry(row.state, json.loads(row.data), stored=True)
+
+    async def _write(self, key: StorageKey, entry: _Entry):
+        db_key = self.key_builder.build(key)
+        async with entry.lock:
+            # Пишем актуальное содержимое на момент записи, а не на момент вызова
+            state, data = entry.state, entry.data
+            async with async_session() as session:
+                if state is None and not data:
+                    # Пустое состояние строки не требует
+                    if entry.stored:
+                        await session.execute(delete(FsmRecord).where(FsmRecord.key == db_key))
+                else:
+                    insert = dialect_insert(FsmRecord)
+                    values = {"state": state, "data": json.dumps(data, ensure_ascii=False), "updated_at": utcnow()}
+                    await session.execute(
+                        insert.values(key=db_key, **values)
+                        .on_conflict_do_update(index_elements=[FsmRecord.key], set_=values)
+                    )
+                await session.commit()
+            entry.stored = state is not None or bool(data)
+            entry.touched = False
+
+    # --- ЧИСТКА ---
+
+    async def _flush_touched(self):
+        """Продлевает updated_at строк, которые читали с прошлой чистки (режим группы живет, пока им пользуются)"""
+        # Пустые записи не продлеваем: это может быть просроченная строка, которую пора удалить
+        keys = [
+            db_key for db_key, entry in self._items.items()
+            if entry.touched and entry.stored and (entry.state is not None or entry.data)
+        ]
+        if not keys: return
+        now = utcnow()
+        async with async_session() as session:
+            for i in range(0, len(keys), TOUCH_CHUNK):
+                stmt = update(FsmRecord).where(FsmRecord.key.in_(keys[i:i + TOUCH_CHUNK])).values(updated_at=now)
+                await session.execute(stmt)
+            await session.commit()
+        for db_key in keys:
+            entry = self._items.get(db_key)
+            if entry: entry.touched = False
+
+    async def sweep(self):
+        await self._flush_touched()
+
+        # Простаивающие ключи - из памяти (в БД они остаются)
+        border = time.monotonic() - self.idle
+        idle_keys = [
+            db_key for db_key, entry in self._items.items()
+            if entry.used_at < border and not entry.lock.locked()
+        ]
+        for db_key in idle_keys:
+            del self._items[db_key]
+
+        # Брошенные состояния - из БД
+        async with async_session() as session:
+            result = await session.execute(
+                delete(FsmRecord).where(FsmRecord.updated_at < utcnow() - timedelta(seconds=self.ttl))
+            )
+            await session.commit()
+        if idle_keys or result.rowcount:
+            logger.info("FSM: выгружено из памяти %s, удалено из БД %s", len(idle_keys), result.rowcount)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(FSM_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("Не удалось почистить FSM: %s", e)
+
+    def __len__(self):
+        return len(self._items)
+
+
+fsm_storage = DbStorage()
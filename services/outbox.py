@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, bindparam, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import OUTBOX_BATCH_DELAY, OUTBOX_FLUSH_INTERVAL, OUTBOX_RETENTION
+from database.base import async_session, dialect_insert
+from database.models import OutboxEntry, Task
+from services.cron import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Строк в одном INSERT/UPDATE (SQLite ограничивает число параметров)
+WRITE_CHUNK = 500
+# Как часто чистить старые обработанные записи (сек)
+PRUNE_INTERVAL = 3600
+
+# executemany: [{"t_id": ..., "t_at": ...}, ...]. Отметка только растет: догоняющий запуск ее не откатит
+ADVANCE_SINCE_STMT = (
+    update(Task.__table__)
+    .where(
+        Task.__table__.c.id == bindparam("t_id"),
+        or_(Task.__table__.c.scheduled_since.is_(None), Task.__table__.c.scheduled_since < bindparam("t_at")),
+    )
+    .values(scheduled_since=bindparam("t_at"))
+)
+
+
+async def insert_entries(session: AsyncSession, keys: list[tuple[int, datetime]]) -> dict[tuple[int, datetime], int]:
+    """
+    Записывает срабатывания (task_id, scheduled_for) в текущей транзакции
+    и сдвигает tasks.scheduled_since задач на последний записанный запуск.
+    Возвращает {ключ: id} только для НОВЫХ строк - уже записанные срабатывания повторно не отправляем.
+    """
+    created = {}
+    now = utcnow()
+    for i in range(0, len(keys), WRITE_CHUNK):
+        rows = [{"task_id": t, "scheduled_for": at, "created_at": now} for t, at in keys[i:i + WRITE_CHUNK]]
+        stmt = (
+            dialect_insert(OutboxEntry).values(rows)
+            .on_conflict_do_nothing(index_elements=["task_id", "scheduled_for"])
+            .returning(OutboxEntry.id, OutboxEntry.task_id, OutboxEntry.scheduled_for)
+        )
+        for entry_id, task_id, at in await session.execute(stmt):
+            created[(task_id, at)] = entry_id
+
+    latest = {}
+    for task_id, at in keys:
+        if task_id not in latest or at > latest[task_id]:
+            latest[task_id] = at
+    if latest:
+        await session.execute(ADVANCE_SINCE_STMT, [{"t_id": t, "t_at": at} for t, at in latest.items()])
+    return created
+
+
+class Outbox:
+    """
+    Журнал срабатываний для доставки ровно один раз.
+    Срабатывания одного тика копятся и пишутся одной транзакцией,
+    отметки об отправке тоже копятся и пишутся раз в OUTBOX_FLUSH_INTERVAL.
+    """
+
+    def __init__(self):
+        # Время запуска процесса: все, что не отправлено до него, - наследство от прошлого запуска
+        self.boot_time = utcnow()
+        self._pending: list[tuple[list[tuple[int, datetime]], asyncio.Future]] = []
+        self._batch: asyncio.Task | None = None
+        self._sent: list[int] = []
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop(), name="outbox")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._flush_sent()
+
+    # --- ЗАПИСЬ СРАБАТЫВАНИЙ ---
+
+    async def record(self, keys: list[tuple[int, datetime]]) -> dict[tuple[int, datetime], int]:
+        """Записывает срабатывания (общей транзакцией на тик). Возвращает {ключ: id} новых строк"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((keys, future))
+        if self._batch is None:
+            self._batch = asyncio.create_task(self._write_batch())
+        return await future
+
+    async def _write_batch(self):
+        await asyncio.sleep(OUTBOX_BATCH_DELAY)
+        pending, self._pending = self._pending, []
+        self._batch = None
+        try:
+            all_keys = list(dict.fromkeys(key for keys, _ in pending for key in keys))
+            async with async_session() as session:
+                created = await insert_entries(session, all_keys)
+                await session.commit()
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        # Один и тот же ключ в пачке мог прийти от двух вызовов - отдаем его только первому
+        for keys, future in pending:
+            future.set_result({key: created.pop(key) for key in keys if key in created})
+
+    # --- ОТМЕТКИ ОБ ОТПРАВКЕ ---
+
+    def mark_sent(self, entry_id: int):
+        self._sent.append(entry_id)
+
+    async def _flush_sent(self):
+        ids, self._sent = self._sent, []
+        if not ids: return
+        now = utcnow()
+        try:
+            async with async_session() as session:
+                for i in range(0, len(ids), WRITE_CHUNK):
+                    stmt = update(OutboxEntry).where(OutboxEntry.id.in_(ids[i:i + WRITE_CHUNK])).values(sent_at=now)
+                    await session.execute(stmt)
+                await session.commit()
+        except Exception as e:
+            # Вернем в буфер - попробуем в следующий раз
+            self._sent.extend(ids)
+            logger.error("Не удалось отметить %s отправок в outbox: %s", len(ids), e)
+
+    async def _prune(self):
+        border = utcnow() - timedelta(seconds=OUTBOX_RETENTION)
+        async with async_session() as session:
+            result = await session.execute(delete(OutboxEntry).where(OutboxEntry.sent_at < border))
+            await session.commit()
+        if result.rowcount:
+            logger.info("Outbox: удалено старых записей: %s", result.rowcount)
+
+    async def _flush_loop(self):
+        last_prune = 0.0
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            await self._flush_sent()
+            if time.monotonic() - last_prune > PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                try:
+                    await self._prune()
+                except Exception as e:
+                    logger.error("Не удалось почистить outbox: %s", e)
+
+    # --- ПОВТОР ПОСЛЕ ПАДЕНИЯ ---
+
+    async def unsent(self, chunk: int = WRITE_CHUNK):
+        """Пачки [(id, task_id), ...] неотправленных срабатываний, записанных до запуска процесса"""
+        last_id = 0
+        while True:
+            async with async_session() as session:
+                query = (
+                    select(OutboxEntry.id, OutboxEntry.task_id)
+                    .where(OutboxEntry.sent_at.is_(None), OutboxEntry.created_at < self.boot_time,
+                           OutboxEntry.id > last_id)
+                    .order_by(OutboxEntry.id)
+                    .limit(chunk)
+                )
+                rows = (await session.execute(query)).all()
+            if not rows: return
+            last_id = rows[-1][0]
+            yield rows
+
+
+outbox = Outbox()
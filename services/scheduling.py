@@ -0,0 +1,444 @@
+import asyncio
+import logging
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.base import STATE_RUNNING
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy import select, update, bindparam
+
+from config import SCHEDULER_MODE, DB_SCHEDULER_POLL, DB_SCHEDULER_BATCH, MISFIRE_GRACE, MISFIRE_MAX_CATCHUP
+from database.base import async_session
+from database.models import Task, User
+from services.cron import get_cron, get_zone, get_trigger, utcnow
+from services.delivery import delivery, SendIntent
+from services.outbox import outbox, insert_entries
+from services.task_cache import task_cache
+
+logger = logging.getLogger(__name__)
+
+# Опоздавшие джобы не выбрасываем (по умолчанию APScheduler пропускает все, что опоздало на 1 сек):
+# джоба срабатывает один раз, а что отправить - решает политика пропусков задачи
+scheduler = AsyncIOScheduler(job_defaults={"coalesce": True, "misfire_grace_time": None})
+
+# Политики пропущенных запусков (Task.misfire_policy)
+MISFIRE_POLICIES = ("skip", "once", "all")
+DEFAULT_MISFIRE_POLICY = "once"
+# Опоздание, при котором запуск еще считается своевременным (cron - с точностью до минуты)
+ON_TIME = timedelta(minutes=1)
+
+
+def next_run_utc(cron: str, tz: str, after: datetime | None = None) -> datetime:
+    """Следующий запуск после after (UTC naive) по расписанию в поясе tz -> UTC naive"""
+    base = (after or utcnow()).replace(tzinfo=timezone.utc)
+    next_local = get_cron(cron).next_fire(get_zone(tz), base)
+    if next_local is None:
+        raise ValueError(f"У выражения '{cron}' нет ближайших запусков")
+    return next_local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def fire_times(cron: str, tz: str, since: datetime, now: datetime) -> list[datetime]:
+    """Плановые запуски (UTC naive) в интервале (since, now], не старше MISFIRE_GRACE"""
+    compiled = get_cron(cron)
+    zone = get_zone(tz)
+    border = now.replace(tzinfo=timezone.utc)
+    at = max(since, now - timedelta(seconds=MISFIRE_GRACE)).replace(tzinfo=timezone.utc)
+    times = []
+    while True:
+        at = compiled.next_fire(zone, at)
+        if at is None or at > border: break
+        times.append(at.astimezone(timezone.utc).replace(tzinfo=None))
+    return times
+
+
+def apply_misfire_policy(times: list[datetime], policy: str, now: datetime) -> list[datetime]:
+    """Какие из плановых запусков (по возрастанию) отправить по политике задачи"""
+    if not times: return []
+    if policy == "all":
+        return times[-MISFIRE_MAX_CATCHUP:]
+    if policy == "skip":
+        return times[-1:] if now - times[-1] <= ON_TIME else []
+    return times[-1:]
+
+
+async def dispatch(task_ids, scheduled_for: datetime):
+    """Ставит задачи в очередь доставки на одно плановое время"""
+    await dispatch_many([(task_id, scheduled_for) for task_id in task_ids])
+
+
+async def dispatch_many(keys: list[tuple[int, datetime]]):
+    """
+    Ставит срабатывания (task_id, плановое время) в очередь доставки. Содержимое берется из кэша задач.
+    Сначала срабатывания пишутся в outbox: уже записанное (повтор после рестарта) второй раз не уйдет.
+    """
+    if not keys: return
+    recorded = await outbox.record(keys)
+    if not recorded: return
+    intents = await task_cache.get_many([task_id for task_id, _ in recorded])
+    for (task_id, _), entry_id in recorded.items():
+        intent = intents.get(task_id)
+        if intent is None:
+            # Задачу удалили, пока писали outbox
+            outbox.mark_sent(entry_id)
+        else:
+            delivery.submit(intent.for_outbox(entry_id))
+
+
+async def replay_outbox():
+    """Досылает срабатывания, записанные до падения, но не отмеченные как отправленные"""
+    total = 0
+    async for rows in outbox.unsent():
+        intents = await task_cache.get_many([task_id for _, task_id in rows])
+        for entry_id, task_id in rows:
+            intent = intents.get(task_id)
+            if intent is None:
+                outbox.mark_sent(entry_id)
+            else:
+                delivery.submit(intent.for_outbox(entry_id))
+                total += 1
+    if total:
+        logger.info("Outbox: повторно поставлено в очередь %s срабатываний", total)
+
+
+async def send_message_job(task_id: int):
+    """Срабатывание джобы: не шлем сами, а ставим в очередь доставки"""
+    job_id = str(task_id)
+    job = scheduler.get_job(job_id)
+    if job is None: return
+    await backend.fire(job_id, job.trigger.cron.expression, job.trigger.timezone.key, [task_id])
+
+
+class _DropAll(logging.Filter):
+    def filter(self, record):
+        return False
+
+
+@contextmanager
+def _quiet_scheduler_log():
+    """Без "Paused/Resumed scheduler job processing" на каждую пачку (импорт, массовые паузы, восстановление)"""
+    aps_logger = logging.getLogger("apscheduler.scheduler")
+    log_filter = _DropAll()
+    aps_logger.addFilter(log_filter)
+    try:
+        yield
+    finally:
+        aps_logger.removeFilter(log_filter)
+
+
+class _ApschedulerBackend:
+    """Общая часть режимов на APScheduler: задачи живут в памяти, при старте их надо восстановить"""
+    in_memory = True
+
+    def __init__(self):
+        # task_id -> политика пропусков (храним только отличные от политики по умолчанию)
+        self.policies: dict[int, str] = {}
+        # id джобы -> когда она последний раз срабатывала (или была создана), UTC naive
+        self.last_fire: dict[str, datetime] = {}
+
+    def set_policy(self, task_id: int, policy: str):
+        if policy == DEFAULT_MISFIRE_POLICY:
+            self.policies.pop(task_id, None)
+        else:
+            self.policies[task_id] = policy
+
+    async def fire(self, job_id: str, cron: str, tz: str, task_ids):
+        """Срабатывание джобы: считает, какие запуски наступили с прошлого раза, и отправляет их"""
+        now = utcnow()
+        since = self.last_fire.get(job_id, now - ON_TIME)
+        self.last_fire[job_id] = now
+        times = fire_times(cron, tz, since, now)
+        if not times: return
+
+        if len(times) == 1 and now - times[0] <= ON_TIME:
+            # Обычный случай: сработали вовремя, политика не важна
+            keys = [(task_id, times[0]) for task_id in task_ids]
+        else:
+            logger.warning("Джоба %s опоздала: пропущено запусков %s, последний %s", job_id, len(times), times[-1])
+            keys = [
+                (task_id, at)
+                for task_id in task_ids
+                for at in apply_misfire_policy(times, self.policies.get(task_id, DEFAULT_MISFIRE_POLICY), now)
+            ]
+        await dispatch_many(keys)
+
+    @contextmanager
+    def batch(self):
+        """
+        Пачка изменений джоб под одной блокировкой хранилища. APScheduler после каждого add_job
+        пересчитывает ближайший запуск, на время пачки он на паузе, и расписание пересчитывается
+        один раз в конце. Внутри пачки не должно быть await: пока планировщик на паузе, джобы не запускаются
+        """
+        # Внутренности APScheduler 3.x (в 4.x API другой, версия закреплена в requirements.txt):
+        # _jobstores_lock - RLock, add_job/remove_job внутри берут его повторно без ожидания
+        with scheduler._jobstores_lock:
+            if scheduler.state != STATE_RUNNING:
+                # Еще не запущен или уже внутри пачки
+                yield
+                return
+            with _quiet_scheduler_log():
+                scheduler.pause()
+            try:
+                yield
+            finally:
+                with _quiet_scheduler_log():
+                    scheduler.resume()
+
+    def schedule_many(self, items) -> dict[int, Exception]:
+        """
+        Регистрирует (или перерегистрирует) пачку задач [(task_id, cron, tz, policy), ...] одной пачкой.
+        Возвращает ошибки по id задачи; задачи с ошибкой не зарегистрированы
+        """
+        errors = {}
+        with self.batch():
+            for task_id, cron, tz, policy in items:
+                try:
+                    self.schedule(task_id, cron, tz, policy)
+                except Exception as e:
+                    errors[task_id] = e
+        return errors
+
+    def unschedule_many(self, task_ids):
+        with self.batch():
+            for task_id in task_ids:
+                self.unschedule(task_id)
+
+    def start(self):
+        scheduler.start()
+
+    async def shutdown(self):
+        scheduler.shutdown(wait=False)
+
+
+class PerTaskBackend(_ApschedulerBackend):
+    """Старый режим: одна джоба APScheduler на каждую задачу"""
+
+    def schedule(self, task_id: int, cron: str, tz: str, policy: str = DEFAULT_MISFIRE_POLICY):
+        scheduler.add_job(
+            send_message_job,
+            trigger=get_trigger(cron, tz),
+            id=str(task_id),
+            kwargs={"task_id": task_id},
+            replace_existing=True
+        )
+        self.last_fire[str(task_id)] = utcnow()
+        self.set_policy(task_id, policy)
+
+    def unschedule(self, task_id: int):
+        try: scheduler.remove_job(str(task_id))
+        except JobLookupError: pass
+        self.last_fire.pop(str(task_id), None)
+        self.policies.pop(task_id, None)
+
+
+# --- FAN-OUT: одна джоба на (cron, timezone) ---
+
+async def fire_group(cron: str, tz: str):
+    """Срабатывание общей джобы: рассылаем всем задачам с этим расписанием"""
+    key = (cron, tz)
+    group = backend.groups.get(key)
+    if not group: return
+    # Копия: пока грузим промахи из БД, группу могут поменять
+    await backend.fire(_group_job_id(key), cron, tz, list(group))
+
+
+def _group_job_id(key: tuple[str, str]) -> str:
+    cron, tz = key
+    return f"cron:{tz}:{cron}"
+
+
+class FanoutBackend(_ApschedulerBackend):
+    """
+    Одна джоба APScheduler на уникальную пару (cron, timezone).
+    Джоба держит набор id задач и при срабатывании рассылает их все,
+    поэтому число джоб и пробуждений = числу разных расписаний, а не задач.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # (cron, tz) -> {task_id, ...}
+        self.groups: dict[tuple[str, str], set[int]] = {}
+        # task_id -> (cron, tz), чтобы переносить задачу при смене расписания
+        self.index: dict[int, tuple[str, str]] = {}
+
+    def schedule(self, task_id: int, cron: str, tz: str, policy: str = DEFAULT_MISFIRE_POLICY):
+        key = (cron, tz)
+        group = self.groups.get(key)
+        if group is None:
+            # Триггер создаем ДО изменения реестра: кривой cron не должен его испортить
+            trigger = get_trigger(cron, tz)
+            scheduler.add_job(
+                fire_group, trigger=trigger, id=_group_job_id(key),
+                args=[cron, tz], replace_existing=True
+            )
+            self.last_fire[_group_job_id(key)] = utcnow()
+            group = self.groups[key] = set()
+
+        old_key = self.index.get(task_id)
+        if old_key is not None and old_key != key:
+            self._detach(task_id, old_key)
+
+        group.add(task_id)
+        self.index[task_id] = key
+        self.set_policy(task_id, policy)
+
+    def unschedule(self, task_id: int):
+        key = self.index.pop(task_id, None)
+        if key is not None:
+            self._detach(task_id, key)
+        self.policies.pop(task_id, None)
+
+    def _detach(self, task_id: int, key: tuple[str, str]):
+        group = self.groups.get(key)
+        if group is None: return
+        group.discard(task_id)
+        if not group:
+            # Последняя задача ушла - убираем джобу
+            del self.groups[key]
+            self.last_fire.pop(_group_job_id(key), None)
+            try: scheduler.remove_job(_group_job_id(key))
+            except JobLookupError: pass
+
+
+# --- DB: расписание хранится в tasks.next_run_at ---
+
+class DbBackend:
+    """
+    Планировщик без APScheduler. Источник правды - колонка tasks.next_run_at:
+    цикл забирает пачками наступившие задачи, отправляет их и сдвигает next_run_at.
+    Память не зависит от числа задач, при старте восстанавливать нечего.
+    """
+    in_memory = False
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    # Запись в БД уже сделали add_task/edit_task/resume_task (они выставляют next_run_at),
+    # политику пропусков цикл читает из tasks.misfire_policy
+    def schedule(self, task_id: int, cron: str, tz: str, policy: str = DEFAULT_MISFIRE_POLICY):
+        pass
+
+    def unschedule(self, task_id: int):
+        pass
+
+    def set_policy(self, task_id: int, policy: str):
+        pass
+
+    def batch(self):
+        return nullcontext()
+
+    def schedule_many(self, items) -> dict[int, Exception]:
+        return {}
+
+    def unschedule_many(self, task_ids):
+        pass
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop(), name="db-scheduler")
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _loop(self):
+        await self._backfill()
+        while True:
+            try:
+                claimed = await self._tick()
+            except Exception as e:
+                logger.exception("Ошибка DB-планировщика: %s", e)
+                claimed = 0
+            # Если забрали полную пачку - вероятно, есть еще, не спим
+            if claimed < DB_SCHEDULER_BATCH:
+                await asyncio.sleep(DB_SCHEDULER_POLL)
+
+    async def _backfill(self):
+        """Считает next_run_at для активных задач, у которых его нет (старые записи)"""
+        total = 0
+        while True:
+            async with async_session() as session:
+                query = (
+                    select(Task.id, Task.cron_expression, User.timezone)
+                    .join(User, Task.user_id == User.user_id)
+                    .where(Task.is_active == True, Task.next_run_at.is_(None))
+                    .limit(DB_SCHEDULER_BATCH)
+                )
+                rows = (await session.execute(query)).all()
+                if not rows: break
+                params = []
+                for task_id, cron, tz in rows:
+                    try:
+                        params.append({"t_id": task_id, "t_next": next_run_utc(cron, tz)})
+                    except Exception as e:
+                        # Кривой cron: выключаем, иначе будем выбирать его вечно
+                        logger.warning("Задача %s: не удалось посчитать next_run_at: %s", task_id, e)
+                        params.append({"t_id": task_id, "t_next": None})
+                        await session.execute(update(Task).where(Task.id == task_id).values(is_active=False))
+                await session.execute(SET_NEXT_RUN_STMT, params)
+                await session.commit()
+                total += len(rows)
+        if total:
+            logger.info("DB-планировщик: посчитан next_run_at для %s задач", total)
+
+    async def _tick(self) -> int:
+        now = utcnow()
+        async with async_session() as session:
+            query = (
+                select(Task, User.timezone)
+                .join(User, Task.user_id == User.user_id)
+                .where(Task.next_run_at <= now, Task.is_active == True)
+                .order_by(Task.next_run_at)
+                .limit(DB_SCHEDULER_BATCH)
+            )
+            rows = (await session.execute(query)).all()
+            if not rows: return 0
+
+            intents = {}
+            params = []
+            for task, tz in rows:
+                intent = SendIntent(task.user_id, task.message_text, task.content_type, task.file_id, task_id=task.id)
+                try:
+                    # next_run_at - сам плановый запуск; если он сильно в прошлом (бот лежал), решает политика
+                    times = fire_times(task.cron_expression, tz, task.next_run_at - timedelta(seconds=1), now)
+                    for at in apply_misfire_policy(times, task.misfire_policy, now):
+                        intents[(task.id, at)] = intent
+                except Exception as e:
+                    logger.warning("Задача %s: не удалось посчитать пропущенные запуски: %s", task.id, e)
+                try:
+                    next_at = next_run_utc(task.cron_expression, tz, after=now)
+                except Exception as e:
+                    logger.warning("Задача %s: не удалось посчитать next_run_at: %s", task.id, e)
+                    next_at = None
+                params.append({"t_id": task.id, "t_next": next_at})
+
+            # Сдвиг next_run_at и запись в outbox - одной транзакцией, отправка - после коммита.
+            # Если упадем после коммита, неотправленное дошлет replay_outbox при старте
+            await session.execute(SET_NEXT_RUN_STMT, params)
+            recorded = await insert_entries(session, list(intents))
+            await session.commit()
+
+        for key, entry_id in recorded.items():
+            delivery.submit(intents[key].for_outbox(entry_id))
+        return len(rows)
+
+
+# executemany: [{"t_id": ..., "t_next": ...}, ...]
+SET_NEXT_RUN_STMT = (
+    update(Task.__table__)
+    .where(Task.__table__.c.id == bindparam("t_id"))
+    .values(next_run_at=bindparam("t_next"))
+)
+
+
+def _create_backend():
+    if SCHEDULER_MODE == "jobs":
+        return PerTaskBackend()
+    if SCHEDULER_MODE == "fanout":
+        return FanoutBackend()
+    if SCHEDULER_MODE == "db":
+        return DbBackend()
+    raise ValueError(f"Неизвестный SCHEDULER_MODE: {SCHEDULER_MODE}")
+
+
+backend = _create_backend()
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from config import TASK_CACHE_SIZE
+from database.base import async_session
+from database.models import Task
+from services.delivery import SendIntent
+
+# SQLite ограничивает число параметров в запросе - грузим промахи пачками
+LOAD_CHUNK = 500
+
+
+class TaskCache:
+    """
+    Ограниченный LRU-кэш содержимого задач (task_id -> SendIntent).
+    Джобы планировщика хранят только id, а текст/файл берется отсюда в момент отправки.
+    При промахе задачи дочитываются из БД одним запросом на пачку.
+    """
+
+    def __init__(self, maxsize: int = TASK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items: OrderedDict[int, SendIntent] = OrderedDict()
+
+    def put(self, task_id: int, intent: SendIntent):
+        self._items[task_id] = intent
+        self._items.move_to_end(task_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, task_id: int):
+        self._items.pop(task_id, None)
+
+    def invalidate_many(self, task_ids):
+        for task_id in task_ids:
+            self._items.pop(task_id, None)
+
+    async def get_many(self, task_ids) -> dict[int, SendIntent]:
+        """Содержимое задач по id. Удаленных задач в ответе нет"""
+        found = {}
+        misses = []
+        for task_id in task_ids:
+            intent = self._items.get(task_id)
+            if intent is None:
+                misses.append(task_id)
+            else:
+                self._items.move_to_end(task_id)
+                found[task_id] = intent
+
+        if misses:
+            async with async_session() as session:
+                for i in range(0, len(misses), LOAD_CHUNK):
+                    chunk = misses[i:i + LOAD_CHUNK]
+                    query = select(
+                        Task.id, Task.user_id, Task.message_text, Task.content_type, Task.file_id
+                    ).where(Task.id.in_(chunk))
+                    for task_id, user_id, text, c_type, f_id in await session.execute(query):
+                        intent = SendIntent(user_id, text, c_type, f_id, task_id=task_id)
+                        self.put(task_id, intent)
+                        found[task_id] = intent
+        return found
+
+    def __len__(self):
+        return len(self._items)
+
+
+task_cache = TaskCache()
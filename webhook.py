@@ -0,0 +1,102 @@
+"""
+Режим вебхука: Telegram сам присылает апдейты POST-запросами на встроенный aiohttp-сервер.
+Несколько реплик за балансировщиком делят апдейты между собой (BOT_REPLICAS: общая база и SCHEDULER_MODE=db, см. README).
+"""
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_MAX_CONNECTIONS, UPDATES_CONCURRENCY,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Принимает апдейт, проверяет секрет и отвечает 200 сразу - обработка идет фоном.
+    Одновременно обрабатывается не больше limit апдейтов: когда слоты заняты, ответ задерживается,
+    и Telegram сам притормаживает отправку (в памяти не копится очередь апдейтов)
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, limit: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get(SECRET_HEADER, ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except ValueError:
+            return web.Response(body="Bad Request", status=400)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({})
+
+    async def _process(self, bot: Bot, update: dict):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            logger.exception("Ошибка обработки апдейта: %s", e)
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        # Дорабатываем начатые апдейты; сессию бота закрывает main вместе с остальным
+        await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Поднимает сервер, регистрирует вебхук (если задан WEBHOOK_URL) и работает до SIGINT/SIGTERM"""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook: задайте WEBHOOK_SECRET")
+
+    app = web.Application()
+    LimitedRequestHandler(dp, bot, UPDATES_CONCURRENCY, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    # startup/shutdown диспетчера - вместе с сервером, как в start_polling
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info("Вебхук слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            # Локальный запуск: апдейты шлем сами (curl), вебхук в Telegram не трогаем
+            logger.warning("WEBHOOK_URL не задан: вебхук в Telegram не зарегистрирован")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError: # Windows
+                pass
+        await stop.wait()
+    finally:
+        # Новые запросы не принимаем, начатые апдейты дорабатывают (close обработчика)
+        await runner.cleanup()